@@ -1,8 +1,12 @@
 import sys
 import os
+import re
+import json
+import hashlib
+from datetime import datetime
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from models import Template
-from app import app
+from pymongo import MongoClient, UpdateOne, DeleteMany
+from config import Config
 
 # Sample templates to insert
 templates = [
@@ -81,20 +85,67 @@ templates = [
 }
 ]
 
+def template_key(name):
+    """Stable key a template is upserted by, e.g. 'Contact Form' -> 'contact-form'."""
+    return re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
+
+
+def templates_checksum():
+    return hashlib.sha256(json.dumps(templates, sort_keys=True).encode()).hexdigest()
+
+
+def seed_templates(db, force=False):
+    """Bring the templates collection in line with `templates`.
+
+    Does nothing when the stored checksum matches (unless forced). Otherwise upserts every
+    template by key and drops stale ones in a single ordered bulk write, so
+    the collection is never empty while seeding runs.
+    """
+    checksum = templates_checksum()
+    state = db.meta.find_one({'_id': 'templates'})
+    if not force and state and state.get('checksum') == checksum:
+        print("Templates unchanged, skipping seed.")
+        return False
+
+    db.templates.create_index('key', unique=True, partialFilterExpression={'key': {'$type': 'string'}})
+    now = datetime.utcnow()
+    keys = [template_key(tpl['name']) for tpl in templates]
+    operations = [
+        UpdateOne(
+            {'key': key},
+            {
+                '$set': {
+                    'name': tpl['name'],
+                    'description': tpl['description'],
+                    'fields': tpl['fields'],
+                    'settings': tpl['settings'],
+                    'updated_at': now
+                },
+                '$setOnInsert': {'created_at': now}
+            },
+            upsert=True
+        )
+        for key, tpl in zip(keys, templates)
+    ]
+    # Also clears templates seeded before keys existed
+    operations.append(DeleteMany({'key': {'$nin': keys}}))
+    result = db.templates.bulk_write(operations, ordered=True)
+    db.meta.update_one(
+        {'_id': 'templates'},
+        {'$set': {'checksum': checksum, 'updated_at': now}},
+        upsert=True
+    )
+    print(f"Seeded templates: {result.upserted_count} inserted, {result.modified_count} updated, "
+          f"{result.deleted_count} removed.")
+    return True
+
+
 def insert_templates():
-    from models import mongo
-    with app.app_context():
-        # Remove all templates first
-        deleted = mongo.db.templates.delete_many({})
-        print(f"Deleted {deleted.deleted_count} existing templates.")
-        for tpl in templates:
-            Template.create(
-                name=tpl['name'],
-                description=tpl['description'],
-                fields=tpl['fields'],
-                settings=tpl['settings']
-            )
-        print(f"Inserted {len(templates)} templates.")
+    client = MongoClient(Config.MONGO_URI)
+    try:
+        seed_templates(client.get_default_database('form_builder'))
+    finally:
+        client.close()
 
 if __name__ == "__main__":
     insert_templates()
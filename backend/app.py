@@ -1,22 +1,57 @@
 from flask import Flask, jsonify, request, make_response
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 from flask_jwt_extended import JWTManager
 from auth import auth_bp
 from forms import forms_bp
 from responses import responses_bp
 from config import Config
-from models import mongo
+from models import mongo, ensure_indexes, init_read_routing, response_writer
+from jobs import job_queue
+import cleanup, sheet_jobs, webhooks  # register background job handlers
+from rate_limit import submission_limiter
+from idempotency import idempotency_keys
+from profiling import request_profiler
+from compression import compression
+from live_feed import response_feed
 
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
+# Trust X-Forwarded-* from the configured number of reverse proxies
+if app.config['PROXY_FIX_HOPS']:
+    hops = app.config['PROXY_FIX_HOPS']
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+
 # Initialize JWTManager
 jwt = JWTManager(app)
 
 # Initialize PyMongo
 mongo.init_app(app)
+init_read_routing(app)
+response_writer.init_app(app)
+
+# Create indexes and start the background job workers
+with app.app_context():
+    try:
+        ensure_indexes()
+        job_queue.ensure_indexes()
+        idempotency_keys.ensure_indexes()
+    except Exception as e:
+        app.logger.error('Failed to create indexes: %s', str(e))
+job_queue.init_app(app)
+
+# Live response feed (change stream started on first subscriber)
+response_feed.init_app(app)
+
+# Initialize submission rate limiting and retry deduplication
+submission_limiter.init_app(app)
+idempotency_keys.init_app(app)
+
+# Opt-in request profiling for admins and sampled routes
+request_profiler.init_app(app)
 
 # Register blueprints
 app.register_blueprint(auth_bp, url_prefix='/api/auth')
@@ -33,13 +68,16 @@ CORS(app,
                  "https://deploy-formpage-frontend-hnpthlkb6.vercel.app"
              ],
              "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-             "allow_headers": ["Content-Type", "Authorization", "Accept"],
-             "expose_headers": ["Content-Type", "Authorization"],
+             "allow_headers": ["Content-Type", "Authorization", "Accept", "X-Profile", "Last-Event-ID", "Idempotency-Key"],
+             "expose_headers": ["Content-Type", "Authorization", "Retry-After", "X-Profile-Id", "Content-Range", "Content-Disposition", "Idempotent-Replayed"],
              "supports_credentials": True,
              "max_age": 3600
          }
      })
 
+# Compress JSON/NDJSON/CSV responses for clients that accept gzip or brotli
+compression.init_app(app)
+
 @app.route('/')
 def index():
     return jsonify({"status": "API is running"})
@@ -71,6 +109,13 @@ def db_status():
         return jsonify({'db': 'error', 'details': str(e)}), 500
 
 
+# Internal/debug endpoint: Google Sheets request queue depth for this worker
+@app.route('/api/internal/sheets-queue', methods=['GET'])
+def sheets_queue_status():
+    from sheets_scheduler import sheets_scheduler
+    return jsonify(sheets_scheduler.stats()), 200
+
+
 # Internal/debug endpoint: environment flag checks (do not return secrets)
 @app.route('/api/internal/env', methods=['GET'])
 def env_info():
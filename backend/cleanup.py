@@ -0,0 +1,79 @@
+import logging
+import time
+
+from bson.objectid import ObjectId
+from flask import current_app
+
+from jobs import job_queue
+from models import mongo, Form
+
+logger = logging.getLogger(__name__)
+
+PURGE_FORM_RESPONSES = 'purge_form_responses'
+
+
+def schedule_form_deletion(form):
+    """Hide a form and queue the background purge of its responses."""
+    form_id = str(form['_id'])
+    Form.mark_deleted(form_id, form['user_id'])
+    return job_queue.enqueue(
+        PURGE_FORM_RESPONSES,
+        {'form_id': form_id, 'user_id': str(form['user_id'])},
+        key=f'{PURGE_FORM_RESPONSES}:{form_id}'
+    )
+
+
+@job_queue.handler(PURGE_FORM_RESPONSES)
+def purge_form_responses(job):
+    """Delete a deleted form's responses and uploads in small batches, then the form itself.
+
+    Each batch is an _id range read from the (form_id, submitted_at, _id)
+    index followed by a delete on those ids, with a pause in between so the
+    purge never holds the database for long. Progress is recorded after every
+    batch; after a restart the job simply continues with what is left.
+    """
+    form_id = ObjectId(job['payload']['form_id'])
+    batch_size = current_app.config.get('PURGE_BATCH_SIZE', 500)
+    pause = current_app.config.get('PURGE_BATCH_PAUSE_MS', 100) / 1000.0
+    deleted = job['progress'].get('deleted_responses', 0)
+
+    def purge_batches():
+        nonlocal deleted
+        while True:
+            ids = [doc['_id'] for doc in mongo.db.responses.find(
+                {'form_id': form_id}, {'_id': 1}
+            ).limit(batch_size)]
+            if not ids:
+                return
+            result = mongo.db.responses.delete_many({'_id': {'$in': ids}})
+            deleted += result.deleted_count
+            job_queue.heartbeat(job, deleted_responses=deleted)
+            if pause:
+                time.sleep(pause)
+
+    def purge_files():
+        from file_storage import uploads_bucket, BUCKET_NAME
+        bucket = uploads_bucket()
+        while True:
+            ids = [doc['_id'] for doc in mongo.db[f'{BUCKET_NAME}.files'].find(
+                {'metadata.form_id': form_id}, {'_id': 1}
+            ).limit(batch_size)]
+            if not ids:
+                return
+            for file_id in ids:
+                bucket.delete(file_id)
+            job_queue.heartbeat(job)
+            if pause:
+                time.sleep(pause)
+
+    job_queue.heartbeat(job, state='purging_responses')
+    purge_batches()
+    job_queue.heartbeat(job, state='purging_files')
+    purge_files()
+    Form.delete(form_id)
+    # Catch submissions that raced the tombstone before it was visible
+    purge_batches()
+    purge_files()
+    mongo.db.webhook_deliveries.delete_many({'form_id': form_id})
+    job_queue.heartbeat(job, state='completed')
+    logger.info(f"Purged form {form_id} and {deleted} responses")
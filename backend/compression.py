@@ -0,0 +1,141 @@
+import gzip
+import hashlib
+import threading
+import time
+import zlib
+
+from flask import request, Response
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/x-ndjson',
+    'text/csv',
+    'text/plain',
+    'text/html',
+}
+
+
+def negotiate_encoding():
+    """Best encoding the client accepts, or None for identity."""
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+class Compression:
+    """gzip/brotli content negotiation for API responses.
+
+    Buffered bodies are compressed when they reach COMPRESSION_MIN_SIZE.
+    Streamed bodies (NDJSON/CSV generators) are compressed chunk by chunk
+    with a sync flush after each chunk, so progress lines still arrive as
+    they are produced.
+    """
+
+    def __init__(self):
+        self.enabled = False
+
+    def init_app(self, app):
+        self.enabled = app.config.get('COMPRESSION_ENABLED', True)
+        self.min_size = app.config.get('COMPRESSION_MIN_SIZE', 1024)
+        self.gzip_level = app.config.get('COMPRESSION_GZIP_LEVEL', 6)
+        self.brotli_quality = app.config.get('COMPRESSION_BROTLI_QUALITY', 5)
+        if self.enabled:
+            app.after_request(self._after_request)
+
+    def _after_request(self, response):
+        if (response.status_code < 200 or response.status_code in (204, 206, 304)
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate_encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self._compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            response.set_data(self._compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            # Different bytes need a different validator
+            response.set_etag(f'{etag}-{encoding}', weak)
+        return response
+
+    def _compress(self, data, encoding):
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.brotli_quality)
+        return gzip.compress(data, compresslevel=self.gzip_level)
+
+    def _compress_stream(self, chunks, encoding):
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                yield compressor.process(chunk) + compressor.flush()
+            yield compressor.finish()
+        else:
+            compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+
+
+class PrecompressedCache:
+    """Immutable JSON payloads kept ready in every encoding.
+
+    Entries are rebuilt when their version changes, or after `max_age`
+    seconds when no version is known.
+    """
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def response(self, key, version, build):
+        """Serve `key`, calling `build()` for the JSON bytes when the cache is stale."""
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if (entry is None or entry['version'] != version
+                or (version is None and now - entry['built'] > self.max_age)):
+            body = build()
+            entry = {
+                'version': version,
+                'built': now,
+                'etag': hashlib.sha1(body).hexdigest(),
+                'identity': body,
+                'gzip': gzip.compress(body, compresslevel=9),
+            }
+            if brotli is not None:
+                entry['br'] = brotli.compress(body, quality=11)
+            with self._lock:
+                self._entries[key] = entry
+
+        encoding = negotiate_encoding()
+        response = Response(entry[encoding or 'identity'], mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+            response.set_etag(f"{entry['etag']}-{encoding}")
+        else:
+            response.set_etag(entry['etag'])
+        response.vary.add('Accept-Encoding')
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+
+compression = Compression()
+precompressed = PrecompressedCache()
@@ -23,8 +23,138 @@ def parse_expiry(val):
             return timedelta(hours=48)  # fallback
     return timedelta(hours=48)
 
+def parse_bool(val, default=False):
+    if val is None:
+        return default
+    return val.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def parse_sample_rates(val):
+    # "forms.get_forms=100,responses.submit_response=1000" -> {'forms.get_forms': 100, ...}
+    rates = {}
+    for item in (val or '').split(','):
+        if '=' in item:
+            endpoint, rate = item.split('=', 1)
+            rates[endpoint.strip()] = int(rate)
+    return rates
+
 class Config:
     MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/form_builder')
     JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY', 'super-secret-key')
     GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
-    JWT_ACCESS_TOKEN_EXPIRES = parse_expiry(os.getenv('JWT_ACCESS_TOKEN_EXPIRES', '24h'))
\ No newline at end of file
+    JWT_ACCESS_TOKEN_EXPIRES = parse_expiry(os.getenv('JWT_ACCESS_TOKEN_EXPIRES', '24h'))
+
+    # Gunicorn sizing (entrypoint.sh reads the same variables)
+    GUNICORN_WORKERS = int(os.getenv('GUNICORN_WORKERS', '2'))
+    GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', '16'))
+
+    # Number of reverse proxies in front of the app. Client IPs (rate limits)
+    # come from X-Forwarded-For only when this is set; behind a proxy with 0,
+    # every client shares the proxy's IP bucket.
+    PROXY_FIX_HOPS = int(os.getenv('PROXY_FIX_HOPS', '0'))
+
+    # Admission control for public submissions (rates are tokens per second)
+    RATE_LIMIT_ENABLED = parse_bool(os.getenv('RATE_LIMIT_ENABLED'), True)
+    RATE_LIMIT_STORAGE = os.getenv('RATE_LIMIT_STORAGE', 'mongo')  # 'mongo' or 'memory'
+    RATE_LIMIT_FORM_RATE = float(os.getenv('RATE_LIMIT_FORM_RATE', '20'))
+    RATE_LIMIT_FORM_BURST = int(os.getenv('RATE_LIMIT_FORM_BURST', '100'))
+    RATE_LIMIT_IP_RATE = float(os.getenv('RATE_LIMIT_IP_RATE', '1'))
+    RATE_LIMIT_IP_BURST = int(os.getenv('RATE_LIMIT_IP_BURST', '10'))
+    # Concurrent submissions across all workers; kept below the total thread
+    # count so the fast 429 can trigger. 'mongo' shares one lease document
+    # between workers, at two extra writes to it per submission (a hot spot
+    # under load); 'memory' splits the cap evenly between worker processes
+    # at no cost and is the default with a single worker.
+    SUBMISSION_SLOT_STORAGE = os.getenv('SUBMISSION_SLOT_STORAGE', 'memory' if GUNICORN_WORKERS == 1 else RATE_LIMIT_STORAGE)
+    SUBMISSION_MAX_CONCURRENCY = int(os.getenv('SUBMISSION_MAX_CONCURRENCY', str(max(1, GUNICORN_WORKERS * GUNICORN_THREADS // 2))))
+    # Worst-case time for one submission; a slot held longer is treated as abandoned
+    SUBMISSION_SLOT_TTL_SECONDS = int(os.getenv('SUBMISSION_SLOT_TTL_SECONDS', '120'))
+
+    # Background jobs (form deletion purge etc.)
+    JOBS_ENABLED = parse_bool(os.getenv('JOBS_ENABLED'), True)
+    JOBS_WORKER_THREADS = int(os.getenv('JOBS_WORKER_THREADS', '2'))
+    JOBS_LEASE_SECONDS = int(os.getenv('JOBS_LEASE_SECONDS', '60'))
+    JOBS_MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', '5'))
+    JOBS_RETENTION_DAYS = int(os.getenv('JOBS_RETENTION_DAYS', '7'))
+    PURGE_BATCH_SIZE = int(os.getenv('PURGE_BATCH_SIZE', '500'))
+    PURGE_BATCH_PAUSE_MS = int(os.getenv('PURGE_BATCH_PAUSE_MS', '100'))
+
+    # Google Sheets request scheduling (rates are requests per second, for the
+    # whole deployment: each of the GUNICORN_WORKERS processes gets an equal share)
+    SHEETS_PROJECT_RATE = float(os.getenv('SHEETS_PROJECT_RATE', '5'))
+    SHEETS_PROJECT_BURST = int(os.getenv('SHEETS_PROJECT_BURST', '10'))
+    SHEETS_SPREADSHEET_RATE = float(os.getenv('SHEETS_SPREADSHEET_RATE', '1'))
+    SHEETS_SPREADSHEET_BURST = int(os.getenv('SHEETS_SPREADSHEET_BURST', '5'))
+    SHEETS_MAX_RETRIES = int(os.getenv('SHEETS_MAX_RETRIES', '6'))
+    SHEETS_BACKOFF_BASE = float(os.getenv('SHEETS_BACKOFF_BASE', '1'))
+    SHEETS_BACKOFF_MAX = float(os.getenv('SHEETS_BACKOFF_MAX', '64'))
+    SHEETS_REQUEST_TIMEOUT = float(os.getenv('SHEETS_REQUEST_TIMEOUT', '30'))
+    # Total Sheets wait for one submission; past it the row is appended by a background job
+    SHEETS_SUBMIT_BUDGET_SECONDS = float(os.getenv('SHEETS_SUBMIT_BUDGET_SECONDS', '10'))
+    SHEETS_WORKER_THREADS = int(os.getenv('SHEETS_WORKER_THREADS', '4'))
+
+    # Read routing for listing/analytics reads: primary, secondary, secondaryPreferred or nearest
+    MONGO_ANALYTICS_READ_PREFERENCE = os.getenv('MONGO_ANALYTICS_READ_PREFERENCE', 'secondaryPreferred')
+    # Max replication lag in seconds for those reads (-1 for no limit, otherwise >= 90)
+    MONGO_ANALYTICS_MAX_STALENESS = int(os.getenv('MONGO_ANALYTICS_MAX_STALENESS', '-1'))
+
+    # On-demand request profiling (no hooks are installed unless enabled)
+    PROFILING_ENABLED = parse_bool(os.getenv('PROFILING_ENABLED'))
+    PROFILING_DIR = os.getenv('PROFILING_DIR', '/tmp/form-profiles')
+    PROFILING_ADMINS = [a.strip() for a in os.getenv('PROFILING_ADMINS', '').split(',') if a.strip()]
+    PROFILING_SAMPLE_RATES = parse_sample_rates(os.getenv('PROFILING_SAMPLE_RATES'))
+    PROFILING_SAMPLE_INTERVAL_MS = int(os.getenv('PROFILING_SAMPLE_INTERVAL_MS', '5'))
+    PROFILING_MAX_FILES = int(os.getenv('PROFILING_MAX_FILES', '200'))
+
+    # Group commit for response inserts: collect concurrent inserts for up to
+    # this many milliseconds and write them with one insert_many (0 disables)
+    RESPONSE_INSERT_WINDOW_MS = float(os.getenv('RESPONSE_INSERT_WINDOW_MS', '2'))
+    RESPONSE_INSERT_MAX_BATCH = int(os.getenv('RESPONSE_INSERT_MAX_BATCH', '100'))
+    # Write concern for response inserts, e.g. '1' or 'majority' (unset: connection default)
+    RESPONSE_WRITE_CONCERN_W = os.getenv('RESPONSE_WRITE_CONCERN_W')
+    RESPONSE_WRITE_CONCERN_J = parse_bool(os.getenv('RESPONSE_WRITE_CONCERN_J'))
+
+    # Incremental Parquet export of responses (export_parquet.py)
+    EXPORT_DIR = os.getenv('EXPORT_DIR', '/tmp/form-exports')
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '5000'))
+    EXPORT_OVERLAP_SECONDS = int(os.getenv('EXPORT_OVERLAP_SECONDS', '300'))
+
+    # CSV import: rows per insert_many and per Sheets append
+    IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', '1000'))
+    IMPORT_SHEETS_BATCH_SIZE = int(os.getenv('IMPORT_SHEETS_BATCH_SIZE', '500'))
+
+    # Response compression (gzip, and brotli when installed)
+    COMPRESSION_ENABLED = parse_bool(os.getenv('COMPRESSION_ENABLED'), True)
+    COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+    COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', '6'))
+    COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', '5'))
+
+    # File fields in multipart submissions (stored in GridFS)
+    UPLOAD_MAX_FILE_BYTES = int(os.getenv('UPLOAD_MAX_FILE_BYTES', str(20 * 1024 * 1024)))
+    UPLOAD_MAX_REQUEST_BYTES = int(os.getenv('UPLOAD_MAX_REQUEST_BYTES', str(50 * 1024 * 1024)))
+    # Non-file parts (the JSON answers) are buffered in memory
+    UPLOAD_MAX_FORM_BYTES = int(os.getenv('UPLOAD_MAX_FORM_BYTES', str(1024 * 1024)))
+
+    # Live response feed over SSE (needs a replica set for change streams).
+    # Each open feed holds one of the worker's GUNICORN_THREADS request
+    # threads, so the per-worker cap stays well below that.
+    LIVE_FEED_MAX_SUBSCRIBERS = int(os.getenv('LIVE_FEED_MAX_SUBSCRIBERS', str(max(1, GUNICORN_THREADS // 4))))
+    LIVE_FEED_QUEUE_SIZE = int(os.getenv('LIVE_FEED_QUEUE_SIZE', '100'))
+    LIVE_FEED_BACKLOG = int(os.getenv('LIVE_FEED_BACKLOG', '1000'))
+    LIVE_FEED_HEARTBEAT_SECONDS = int(os.getenv('LIVE_FEED_HEARTBEAT_SECONDS', '15'))
+
+    # Outbound webhooks
+    WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', '50'))
+    WEBHOOK_BATCH_DELAY_SECONDS = float(os.getenv('WEBHOOK_BATCH_DELAY_SECONDS', '2'))
+    WEBHOOK_TIMEOUT_SECONDS = float(os.getenv('WEBHOOK_TIMEOUT_SECONDS', '10'))
+    WEBHOOK_POOL_SIZE = int(os.getenv('WEBHOOK_POOL_SIZE', '10'))
+    WEBHOOK_RETENTION_DAYS = int(os.getenv('WEBHOOK_RETENTION_DAYS', '7'))
+    # Only for local testing against a receiver on this machine or network
+    WEBHOOK_ALLOW_PRIVATE_TARGETS = parse_bool(os.getenv('WEBHOOK_ALLOW_PRIVATE_TARGETS'))
+
+    # Idempotency-Key handling for submissions
+    IDEMPOTENCY_ENABLED = parse_bool(os.getenv('IDEMPOTENCY_ENABLED'), True)
+    IDEMPOTENCY_TTL_HOURS = int(os.getenv('IDEMPOTENCY_TTL_HOURS', '24'))
+    # A claim is only taken over once its request must be gone: past the
+    # worst-case submit time (the slot lease, which already covers uploads and
+    # the Sheets budget) plus the same again as margin
+    IDEMPOTENCY_LOCK_SECONDS = int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', str(max(2 * SUBMISSION_SLOT_TTL_SECONDS, int(SHEETS_SUBMIT_BUDGET_SECONDS) + 60))))
@@ -0,0 +1,174 @@
+import os
+import re
+import csv
+import sys
+import json
+import codecs
+from datetime import datetime
+from bson.objectid import ObjectId
+
+from models import mongo
+from sheet_jobs import column_key
+
+EMAIL_RE = re.compile(r"[^@]+@[^@]+\.[^@]+")
+PHONE_RE = re.compile(r"\+?[\d\s\-()]*\d[\d\s\-()]*")
+PHONE_SEPARATORS = re.compile(r"[\s\-()]")
+SUBMITTED_AT = object()  # column carrying the original submission time
+TIMESTAMP_COLUMNS = ('submitted_at', 'timestamp', 'submitted at')
+CHOICE_TYPES = ('dropdown', 'radio', 'select')
+
+
+def map_columns(header, fields):
+    """Match CSV columns to form fields by field id or label (case-insensitive)."""
+    by_name = {}
+    for field in fields:
+        if not field or field.get('type') in ('section', 'file'):
+            continue
+        for name in (field.get('id'), field.get('label')):
+            if name:
+                by_name.setdefault(name.strip().lower(), field)
+    mapping = []
+    for column in header:
+        name = column.strip().lower()
+        mapping.append(SUBMITTED_AT if name in TIMESTAMP_COLUMNS else by_name.get(name))
+    return mapping
+
+
+def _convert(field, value):
+    """Validate one cell; returns (value, error)."""
+    field_type = field.get('type')
+    options = field.get('options') or []
+    if field_type == 'email' and not EMAIL_RE.match(value):
+        return None, 'invalid email'
+    if field_type in ('number', 'rating'):
+        try:
+            float(value)
+        except ValueError:
+            return None, 'not a number'
+    if field_type == 'date':
+        try:
+            datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            return None, 'date must be YYYY-MM-DD'
+    if field_type == 'telephone':
+        if not PHONE_RE.fullmatch(value.strip()):
+            return None, 'telephone may only contain digits, spaces, dashes, parentheses and a leading +'
+        # Stored without formatting, like numbers entered in the form
+        return PHONE_SEPARATORS.sub('', value), None
+    if field_type == 'checkbox':
+        choices = [v.strip() for v in value.split(';') if v.strip()]
+        unknown = [v for v in choices if options and v not in options]
+        if unknown:
+            return None, f"unknown option(s): {', '.join(unknown)}"
+        return choices, None
+    if field_type in CHOICE_TYPES and options and value not in options:
+        return None, 'unknown option'
+    return value, None
+
+
+def validate_row(values, mapping, required):
+    """Turn one CSV row into (data, submitted_at, errors)."""
+    data = {}
+    submitted_at = None
+    errors = []
+    for value, field in zip(values, mapping):
+        value = value.strip()
+        if field is None or not value:
+            continue
+        if field is SUBMITTED_AT:
+            try:
+                submitted_at = datetime.fromisoformat(value.rstrip('Z'))
+            except ValueError:
+                errors.append({'column': 'submitted_at', 'error': 'invalid timestamp'})
+            continue
+        converted, error = _convert(field, value)
+        if error:
+            errors.append({'column': field.get('label') or field.get('id'), 'error': error})
+        else:
+            data[column_key(field)] = converted
+    for field in required:
+        if column_key(field) not in data:
+            errors.append({'column': field.get('label') or field.get('id'), 'error': 'required'})
+    return data, submitted_at, errors
+
+
+def import_csv(form, stream, chunk_size=1000):
+    """Import responses from a binary CSV stream, yielding progress events.
+
+    Rows are decoded and validated one at a time and written with
+    insert_many every `chunk_size` valid rows, so memory stays bounded
+    whatever the file size. Invalid rows are reported and skipped. Imported
+    responses share an import_id, which the Sheets append job uses.
+    """
+    fields = form.get('fields', []) or []
+    import_id = ObjectId()
+    reader = csv.reader(codecs.iterdecode(stream, 'utf-8-sig'))
+    try:
+        header = next(reader)
+    except StopIteration:
+        yield {'event': 'error', 'error': 'CSV file is empty'}
+        return
+    mapping = map_columns(header, fields)
+    mapped_fields = [f for f in mapping if f is not None and f is not SUBMITTED_AT]
+    required = [f for f in fields if f and f.get('required') and f in mapped_fields]
+    yield {
+        'event': 'start',
+        'import_id': str(import_id),
+        'columns': {
+            column: ('submitted_at' if f is SUBMITTED_AT else column_key(f) if f else None)
+            for column, f in zip(header, mapping)
+        }
+    }
+
+    rows = imported = failed = 0
+    chunk = []
+    line = reader.line_num + 1
+    for values in reader:
+        # Physical line the record starts on; quoted cells may span several lines
+        start, line = line, reader.line_num + 1
+        rows += 1
+        if not any(v.strip() for v in values):
+            continue
+        data, submitted_at, errors = validate_row(values, mapping, required)
+        if errors:
+            failed += 1
+            yield {'event': 'row_error', 'line': start, 'errors': errors}
+            continue
+        chunk.append({
+            'form_id': form['_id'],
+            'data': data,
+            'submitted_at': submitted_at or datetime.utcnow(),
+            'import_id': import_id
+        })
+        if len(chunk) >= chunk_size:
+            imported += len(mongo.db.responses.insert_many(chunk, ordered=False).inserted_ids)
+            chunk = []
+            yield {'event': 'progress', 'rows': rows, 'imported': imported, 'failed': failed}
+    if chunk:
+        imported += len(mongo.db.responses.insert_many(chunk, ordered=False).inserted_ids)
+
+    sheets_job_id = None
+    if imported:
+        from sheet_jobs import sheet_target, schedule_import_append
+        if sheet_target(form)[0]:
+            sheets_job_id = str(schedule_import_append(form['_id'], import_id))
+    yield {'event': 'done', 'import_id': str(import_id), 'rows': rows, 'imported': imported,
+           'failed': failed, 'sheets_job_id': sheets_job_id}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: python csv_import.py FORM_ID FILE.csv')
+        sys.exit(1)
+    # The server's workers pick up the Sheets append job; don't start any here
+    os.environ['JOBS_ENABLED'] = 'false'
+    from app import app
+    from models import Form
+    with app.app_context():
+        form = Form.find_by_id(sys.argv[1])
+        if not form:
+            print('Form not found')
+            sys.exit(1)
+        with open(sys.argv[2], 'rb') as f:
+            for event in import_csv(form, f, app.config['IMPORT_CHUNK_SIZE']):
+                print(json.dumps(event))
@@ -1,10 +1,10 @@
 #!/bin/sh
 
-# Seed templates (ignore errors if already seeded)
+# Seed templates (no-op when the template set is unchanged)
 
 python add_templates.py || true
 
-# Start Gunicorn server
+# Start Gunicorn server (threaded workers; config.py reads GUNICORN_WORKERS/GUNICORN_THREADS to size the submission and live feed caps)
 
-exec gunicorn --bind 0.0.0.0:5000 app:app
+exec gunicorn --bind 0.0.0.0:5000 --worker-class gthread --workers ${GUNICORN_WORKERS:-2} --threads ${GUNICORN_THREADS:-16} app:app
 
@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import uuid
+import argparse
+from datetime import datetime, timedelta
+from collections import defaultdict
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from bson import json_util
+from bson.objectid import ObjectId
+from pymongo import MongoClient, ReadPreference, ASCENDING
+from config import Config
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed when an export actually runs
+    pa = pq = None
+
+WATERMARK_FILE = '_watermark.json'
+
+
+def _to_float(value):
+    try:
+        return float(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_date(value):
+    try:
+        return datetime.strptime(str(value)[:10], '%Y-%m-%d').date() if value else None
+    except ValueError:
+        return None
+
+
+def _to_list(value):
+    if value in (None, ''):
+        return None
+    if isinstance(value, list):
+        return [str(v) for v in value]
+    return [str(value)]
+
+
+def _to_string(value):
+    if value is None:
+        return None
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def form_columns(form):
+    """(column name, data keys, arrow type, converter) for each field of the form."""
+    types = {
+        'number': (pa.float64(), _to_float),
+        'rating': (pa.float64(), _to_float),
+        'date': (pa.date32(), _to_date),
+        'checkbox': (pa.list_(pa.string()), _to_list),
+    }
+    columns = []
+    seen = set()
+    for field in form.get('fields', []) or []:
+        if not field or field.get('type') == 'section':
+            continue
+        keys = [k for k in (field.get('id'), field.get('label')) if k]
+        if not keys:
+            continue
+        name = field.get('label') or field.get('id')
+        if name in seen:
+            name = f"{name} ({field.get('id')})"
+        seen.add(name)
+        arrow_type, convert = types.get(field.get('type'), (pa.string(), _to_string))
+        columns.append((name, keys, arrow_type, convert))
+    return columns
+
+
+def _read_watermark(form_dir):
+    """Return (last _id, ids exported inside the overlap window), or None.
+
+    Marks written before the overlap window existed have no id list; they
+    are returned with `recent` None and resumed strictly after the _id.
+    """
+    path = os.path.join(form_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    recent = state.get('recent')
+    return ObjectId(state['_id']), None if recent is None else {ObjectId(i) for i in recent}
+
+
+def _write_watermark(form_dir, last_id, recent):
+    path = os.path.join(form_dir, WATERMARK_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'_id': str(last_id), 'recent': sorted(str(i) for i in recent)}, f)
+    os.replace(path + '.tmp', path)
+
+
+def _write_batch(form_dir, columns, schema, rows):
+    """Write one batch of responses, one file per submission date."""
+    by_date = defaultdict(list)
+    for row in rows:
+        by_date[row['submitted_at'].date()].append(row)
+    known_keys = {key for _, keys, _, _ in columns for key in keys}
+
+    for day, day_rows in by_date.items():
+        arrays = [
+            pa.array([str(r['_id']) for r in day_rows], pa.string()),
+            pa.array([r['submitted_at'] for r in day_rows], pa.timestamp('ms')),
+        ]
+        for _, keys, arrow_type, convert in columns:
+            values = []
+            for r in day_rows:
+                data = r.get('data') or {}
+                value = next((data[k] for k in keys if k in data), None)
+                values.append(convert(value))
+            arrays.append(pa.array(values, arrow_type))
+        extras = []
+        for r in day_rows:
+            extra = {k: v for k, v in (r.get('data') or {}).items() if k not in known_keys}
+            extras.append(json_util.dumps(extra) if extra else None)
+        arrays.append(pa.array(extras, pa.string()))
+
+        partition = os.path.join(form_dir, f'date={day.isoformat()}')
+        os.makedirs(partition, exist_ok=True)
+        # Named after the first row so a rerun after a crash overwrites rather than duplicates
+        first = day_rows[0]
+        name = f"part-{first['submitted_at'].strftime('%Y%m%dT%H%M%S%f')}-{first['_id']}.parquet"
+        tmp_path = os.path.join(partition, f'.{uuid.uuid4().hex}.tmp')
+        pq.write_table(pa.Table.from_arrays(arrays, schema=schema), tmp_path, compression='zstd')
+        os.replace(tmp_path, os.path.join(partition, name))
+
+
+def export_form(db, form, out_dir, batch_size=5000, overlap=300):
+    """Append a form's responses not exported yet. Returns rows written.
+
+    The high-water mark is the _id, assigned when a response is inserted,
+    not submitted_at: CSV imports insert rows with their original, older
+    submission times. _ids from different workers are not strictly in
+    commit order, and a lagging secondary can show a row late, so each run
+    re-reads the last `overlap` seconds of _ids and skips the ids already
+    exported there.
+    """
+    columns = form_columns(form)
+    schema = pa.schema(
+        [('_id', pa.string()), ('submitted_at', pa.timestamp('ms'))]
+        + [(name, arrow_type) for name, _, arrow_type, _ in columns]
+        + [('_extra', pa.string())]
+    )
+    form_dir = os.path.join(out_dir, f"form_id={form['_id']}")
+    os.makedirs(form_dir, exist_ok=True)
+
+    query = {'form_id': form['_id']}
+    last_id, recent = None, set()
+    watermark = _read_watermark(form_dir)
+    if watermark:
+        last_id, recent = watermark
+        if recent is None:
+            recent = set()
+            query['_id'] = {'$gt': last_id}
+        else:
+            query['_id'] = {'$gte': ObjectId.from_datetime(last_id.generation_time - timedelta(seconds=overlap))}
+
+    def flush(rows):
+        nonlocal last_id, recent
+        _write_batch(form_dir, columns, schema, rows)
+        ids = [r['_id'] for r in rows]
+        last_id = max(ids + ([last_id] if last_id else []))
+        window_start = last_id.generation_time - timedelta(seconds=overlap)
+        recent = {i for i in recent | {r['_id'] for r in rows} if i.generation_time >= window_start}
+        _write_watermark(form_dir, last_id, recent)
+
+    responses = db.get_collection('responses', read_preference=ReadPreference.SECONDARY_PREFERRED)
+    cursor = responses.find(query).sort('_id', ASCENDING).batch_size(batch_size)
+    total = 0
+    rows = []
+    for doc in cursor:
+        if doc['_id'] in recent:
+            continue
+        rows.append(doc)
+        if len(rows) >= batch_size:
+            flush(rows)
+            total += len(rows)
+            rows = []
+    if rows:
+        flush(rows)
+        total += len(rows)
+    return total
+
+
+def export_all(db, out_dir, form_id=None, batch_size=5000, overlap=300):
+    if pa is None:
+        raise RuntimeError('pyarrow is required for Parquet export (pip install pyarrow)')
+    query = {'deleted_at': None}
+    if form_id:
+        query['_id'] = ObjectId(form_id)
+    for form in db.forms.find(query, {'fields': 1}):
+        written = export_form(db, form, out_dir, batch_size, overlap)
+        print(f"Form {form['_id']}: exported {written} new responses.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Incrementally export responses to Parquet, partitioned by form and date.')
+    parser.add_argument('--form', help='only export this form id')
+    parser.add_argument('--out', default=Config.EXPORT_DIR, help='output directory')
+    parser.add_argument('--batch-size', type=int, default=Config.EXPORT_BATCH_SIZE,
+                        help='responses per cursor batch and output file')
+    parser.add_argument('--overlap', type=int, default=Config.EXPORT_OVERLAP_SECONDS,
+                        help='seconds of already exported _ids re-read to catch late rows')
+    args = parser.parse_args()
+    client = MongoClient(Config.MONGO_URI)
+    try:
+        export_all(client.get_default_database('form_builder'), args.out, args.form, args.batch_size, args.overlap)
+    finally:
+        client.close()
@@ -0,0 +1,177 @@
+import json
+
+import gridfs
+from bson.objectid import ObjectId
+from flask import request, Response as HttpResponse
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
+
+from models import mongo
+from sheet_jobs import column_key
+
+BUCKET_NAME = 'uploads'
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+
+def uploads_bucket():
+    return gridfs.GridFSBucket(mongo.db, bucket_name=BUCKET_NAME)
+
+
+class GridFSUploadStream:
+    """Write target handed to Werkzeug's multipart parser.
+
+    Each chunk the parser reads off the socket goes straight into a GridFS
+    file, so an upload never sits in memory or in a temp file as a whole.
+    """
+
+    def __init__(self, grid_in, max_bytes):
+        self.grid_in = grid_in
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.closed = False
+
+    @property
+    def file_id(self):
+        return self.grid_in._id
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise RequestEntityTooLarge(f'File exceeds {self.max_bytes} bytes')
+        self.grid_in.write(data)
+
+    def seek(self, offset, whence=0):
+        # The parser rewinds finished parts; GridFS input is write-only
+        pass
+
+    def close(self):
+        self.grid_in.close()
+        self.closed = True
+
+    def discard(self, bucket):
+        if self.closed:
+            bucket.delete(self.file_id)
+        else:
+            self.grid_in.abort()
+
+
+def parse_multipart_submission(form, max_file_bytes, max_request_bytes, max_form_bytes):
+    """Parse a multipart submission, streaming `file` fields into GridFS.
+
+    The answers come either as one JSON `data` part or as plain form fields;
+    each file part must be named after a `file` field's id or label. Returns
+    the response data with each file replaced by a reference to it in GridFS.
+    Non-file parts are held in memory, so together they are capped at
+    `max_form_bytes`. Raises ValueError for bad input; stored files are
+    removed on any failure.
+    """
+    bucket = uploads_bucket()
+    streams = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        grid_in = bucket.open_upload_stream(
+            filename or 'upload',
+            metadata={'form_id': form['_id'], 'content_type': content_type}
+        )
+        stream = GridFSUploadStream(grid_in, max_file_bytes)
+        streams.append(stream)
+        return stream
+
+    try:
+        _, form_data, files = parse_form_data(
+            request.environ,
+            stream_factory=stream_factory,
+            max_content_length=max_request_bytes,
+            max_form_memory_size=max_form_bytes,
+            silent=False
+        )
+        if 'data' in form_data:
+            data = json.loads(form_data['data'])
+            if not isinstance(data, dict):
+                raise ValueError('data must be a JSON object')
+        else:
+            data = form_data.to_dict()
+
+        file_fields = {}
+        for field in form.get('fields', []) or []:
+            if field and field.get('type') == 'file':
+                for key in (field.get('id'), field.get('label')):
+                    if key:
+                        file_fields[key] = field
+
+        for name, upload in files.items(multi=True):
+            stream = upload.stream
+            stream.close()
+            if name not in file_fields:
+                raise ValueError(f'Unexpected file part: {name}')
+            # Parts may be named by label; store under the key the other answers and the sheet use
+            key = column_key(file_fields[name])
+            if key != name:
+                data.pop(name, None)
+            data[key] = {
+                'file_id': str(stream.file_id),
+                'filename': upload.filename,
+                'content_type': upload.content_type,
+                'size': stream.size
+            }
+        return data
+    except Exception:
+        for stream in streams:
+            stream.discard(bucket)
+        raise
+
+
+def delete_files(data):
+    bucket = uploads_bucket()
+    for value in data.values():
+        if isinstance(value, dict) and 'file_id' in value:
+            try:
+                bucket.delete(ObjectId(value['file_id']))
+            except gridfs.errors.NoFile:
+                pass
+
+
+def download_response(form_id, file_id):
+    """Stream a stored file, honouring a single byte range."""
+    try:
+        grid_out = uploads_bucket().open_download_stream(ObjectId(file_id))
+    except Exception:
+        # Unknown or malformed id
+        return None
+    if str((grid_out.metadata or {}).get('form_id')) != str(form_id):
+        return None
+
+    length = grid_out.length
+    start, stop = 0, length
+    status = 200
+    if request.range is not None:
+        requested = request.range.range_for_length(length)
+        if requested is None and len(request.range.ranges) == 1:
+            response = HttpResponse(status=416)
+            response.headers['Content-Range'] = f'bytes */{length}'
+            return response
+        if requested is not None:
+            start, stop = requested
+            status = 206
+
+    def generate():
+        grid_out.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = grid_out.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    metadata = grid_out.metadata or {}
+    response = HttpResponse(generate(), status=status,
+                            mimetype=metadata.get('content_type') or 'application/octet-stream',
+                            direct_passthrough=True)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Length'] = str(stop - start)
+    if status == 206:
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+    response.headers.set('Content-Disposition', 'attachment', filename=grid_out.filename)
+    response.set_etag(str(grid_out._id))
+    return response
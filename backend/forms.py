@@ -1,8 +1,10 @@
 from flask import Blueprint, request, jsonify
 
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask_jwt_extended import jwt_required, get_jwt_identity, verify_jwt_in_request
 
-from models import Form
+from models import Form, READ_PRIMARY, READ_CONSISTENT
+
+from webhooks import clean_webhooks
 
 from bson.objectid import ObjectId
 
@@ -30,7 +32,11 @@ def get_forms():
 
   print('Fetching forms for user_id:', user_id)
 
-  forms = Form.find_by_user(user_id)
+  # Secondary read that still includes forms the user just created, edited or deleted
+
+  with Form.dashboard_session(user_id) as session:
+
+    forms = Form.find_by_user(user_id, read=READ_CONSISTENT, session=session)
 
   for form in forms:
 
@@ -51,11 +57,22 @@ def get_forms():
     try:
       # import here to avoid circular imports at module load
       import add_templates
-      add_templates.insert_templates()
+      from models import mongo
+      add_templates.seed_templates(mongo.db, force=True)
       templates = Template.find_all()
     except Exception as e:
       print('Failed to seed templates:', e)
 
+  serialize_templates(templates)
+
+  print('Forms found:', forms)
+
+  print('Templates found:', templates)
+
+  return jsonify({'forms': forms, 'templates': templates}), 200
+
+def serialize_templates(templates):
+
   for template in templates:
 
     template['id'] = str(template['_id'])
@@ -72,11 +89,27 @@ def get_forms():
 
       template['updated_at'] = str(template['updated_at'])
 
-  print('Forms found:', forms)
+  return templates
 
-  print('Templates found:', templates)
+@forms_bp.route('/templates', methods=['GET'])
 
-  return jsonify({'forms': forms, 'templates': templates}), 200
+def get_templates():
+
+  # The catalog only changes when templates are reseeded, so serve a cached, precompressed body
+
+  import json
+
+  from models import Template, mongo
+
+  from compression import precompressed
+
+  meta = mongo.db.meta.find_one({'_id': 'templates'}, {'checksum': 1}) or {}
+
+  def build():
+
+    return json.dumps({'templates': serialize_templates(Template.find_all())}).encode()
+
+  return precompressed.response('templates', meta.get('checksum'), build)
 
 @forms_bp.route('/<form_id>', methods=['GET'])
 
@@ -88,6 +121,22 @@ def get_form(form_id):
 
     return jsonify({'error': 'Form not found'}), 404
 
+  # Public endpoint: webhook urls and signing secrets are only shown to the owner
+
+  try:
+
+    verify_jwt_in_request(optional=True)
+
+    viewer = get_jwt_identity()
+
+  except Exception:
+
+    viewer = None
+
+  if viewer != str(form.get('user_id')):
+
+    (form.get('settings') or {}).pop('webhooks', None)
+
   # Convert ObjectId fields to string for JSON serialization
 
   form['_id'] = str(form['_id'])
@@ -134,6 +183,14 @@ def create_form():
 
       settings['google_sheet_name'] = data['settings']['google_sheet_name']
 
+  try:
+
+    clean_webhooks(settings)
+
+  except ValueError as e:
+
+    return jsonify({'error': 'Invalid webhooks', 'details': str(e)}), 400
+
   # Generate a user-friendly, unique sheet name based on the form title
 
   import re
@@ -152,7 +209,9 @@ def create_form():
 
   from models import Form as FormModel
 
-  existing_names = [f.get('google_sheet_name', '') for f in FormModel.find_by_user(user_id)]
+  # Primary read: a lagging secondary could hand two forms the same tab
+
+  existing_names = [f.get('google_sheet_name', '') for f in FormModel.find_by_user(user_id, read=READ_PRIMARY)]
 
   sheet_name = base_sheet_name
 
@@ -188,6 +247,18 @@ def create_form():
 
     print('Form created with id:', form_id.inserted_id)
 
+    # Create the sheet tab and headers now rather than on the first submission
+
+    try:
+
+      from sheet_jobs import schedule_sheet_provisioning
+
+      schedule_sheet_provisioning(form_id.inserted_id)
+
+    except Exception as e:
+
+      print('Could not queue sheet provisioning:', str(e))
+
     return jsonify({
 
       'message': 'Form created successfully',
@@ -232,16 +303,6 @@ def update_form(form_id):
 
   user_id = get_jwt_identity()
 
-  form = Form.find_by_id(form_id)
-
-  if not form:
-
-    return jsonify({'error': 'Form not found'}), 404
-
-  if str(form['user_id']) != user_id:
-
-    return jsonify({'error': 'Unauthorized'}), 403
-
   data = request.get_json()
 
   updates = {}
@@ -250,131 +311,135 @@ def update_form(form_id):
 
     updates['title'] = data['title']
 
-    # Also update the google_sheet_name to match the new title
+    # Also update the google_sheet_name to match the new title; the tab itself is renamed in the background
 
     import re
 
     safe_title = re.sub(r'[^A-Za-z0-9 ]+', '', data['title'].strip())[:30].strip()
 
-    new_sheet_name = f"{safe_title} sheet" if safe_title else 'Untitled Form sheet'
+    updates['google_sheet_name'] = f"{safe_title} sheet" if safe_title else 'Untitled Form sheet'
 
-    # Rename the actual Google Sheet tab if the name changed
+  if 'description' in data:
 
-    old_sheet_name = form.get('google_sheet_name', 'Sheet1')
+    updates['description'] = data['description']
 
-    updates['google_sheet_name'] = new_sheet_name
+  if 'fields' in data:
 
-    if old_sheet_name != new_sheet_name:
+    updates['fields'] = data['fields']
 
-      try:
+  if 'settings' in data:
 
-        from google_sheets import sheets_service
+    updates['settings'] = data['settings']
 
-        spreadsheet_id = form.get('settings', {}).get('google_sheet_id', '1Xwj99Lj0ujjZEpoZ5vuhxeILKT96dCq8a6fGb4nYnjU')
+    try:
 
-        # Find the sheetId for the old sheet name
+      clean_webhooks(updates['settings'])
 
-        sheet_info = sheets_service.service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+    except ValueError as e:
 
-        sheet_id = None
+      return jsonify({'error': 'Invalid webhooks', 'details': str(e)}), 400
 
-        for sheet in sheet_info.get('sheets', []):
+  print(f'Updating form {form_id} for user {user_id} with updates:', updates)
 
-          if sheet['properties']['title'] == old_sheet_name:
+  # Ownership check and update in a single round trip
 
-            sheet_id = sheet['properties']['sheetId']
+  updated_form = Form.update_owned(form_id, user_id, updates)
 
-            break
+  if not updated_form:
 
-        if sheet_id is not None:
+    if not Form.find_by_id(form_id):
 
-          requests = [{
+      return jsonify({'error': 'Form not found'}), 404
 
-            'updateSheetProperties': {
+    return jsonify({'error': 'Unauthorized'}), 403
 
-              'properties': {
+  if updated_form.get('sheet_rename_from'):
 
-                'sheetId': sheet_id,
+    from sheet_jobs import schedule_sheet_rename
 
-                'title': new_sheet_name
+    schedule_sheet_rename(form_id)
 
-              },
+  elif {'fields', 'title', 'settings'} & set(updates):
 
-              'fields': 'title'
+    # Bring the tab's header row in line with the new fields before anyone submits
 
-            }
+    from sheet_jobs import schedule_sheet_provisioning
 
-          }]
+    schedule_sheet_provisioning(form_id)
 
-          sheets_service.service.spreadsheets().batchUpdate(
+  # Return updated form with both 'id' and '_id'
 
-            spreadsheetId=spreadsheet_id,
+  updated_form['_id'] = str(updated_form['_id'])
 
-            body={'requests': requests}
+  updated_form['id'] = str(updated_form['_id'])
 
-          ).execute()
+  if 'user_id' in updated_form:
 
-      except Exception as e:
+    updated_form['user_id'] = str(updated_form['user_id'])
 
-        print(f"Failed to rename Google Sheet tab: {e}")
+  return jsonify({'message': 'Form updated successfully', 'form': updated_form}), 200
 
-  if 'description' in data:
+@forms_bp.route('/<form_id>', methods=['DELETE'])
 
-    updates['description'] = data['description']
+@jwt_required()
 
-  if 'fields' in data:
+def delete_form(form_id):
 
-    updates['fields'] = data['fields']
+  user_id = get_jwt_identity()
 
-  if 'settings' in data:
+  form = Form.find_by_id(form_id)
 
-    updates['settings'] = data['settings']
+  if not form:
 
-  print(f'Updating form {form_id} for user {user_id} with updates:', updates)
+    return jsonify({'error': 'Form not found'}), 404
 
-  result = Form.update(form_id, updates)
+  if str(form['user_id']) != user_id:
 
-  print('Update result:', result.raw_result if hasattr(result, 'raw_result') else result)
+    return jsonify({'error': 'Unauthorized'}), 403
 
-  # Return updated form with both 'id' and '_id'
+  # Responses are removed by a background job so large forms don't stall the request
 
-  updated_form = Form.find_by_id(form_id)
+  from cleanup import schedule_form_deletion
 
-  if updated_form:
+  job_id = schedule_form_deletion(form)
 
-    updated_form['_id'] = str(updated_form['_id'])
+  return jsonify({'message': 'Form deleted successfully', 'deletion_job_id': str(job_id)}), 202
 
-    updated_form['id'] = str(updated_form['_id'])
+@forms_bp.route('/<form_id>/deletion', methods=['GET'])
 
-    if 'user_id' in updated_form:
+@jwt_required()
 
-      updated_form['user_id'] = str(updated_form['user_id'])
+def get_form_deletion(form_id):
 
-    return jsonify({'message': 'Form updated successfully', 'form': updated_form}), 200
+  user_id = get_jwt_identity()
 
-  return jsonify({'message': 'Form updated successfully'}), 200
+  from cleanup import PURGE_FORM_RESPONSES
 
-@forms_bp.route('/<form_id>', methods=['DELETE'])
+  from jobs import job_queue
 
-@jwt_required()
+  job = job_queue.find_latest(PURGE_FORM_RESPONSES, form_id)
 
-def delete_form(form_id):
+  if not job or job['payload'].get('user_id') != user_id:
 
-  user_id = get_jwt_identity()
+    return jsonify({'error': 'No deletion found for this form'}), 404
 
-  form = Form.find_by_id(form_id)
+  return jsonify({
 
-  if not form:
+    'form_id': form_id,
 
-    return jsonify({'error': 'Form not found'}), 404
+    'status': job['status'],
 
-  if str(form['user_id']) != user_id:
+    'state': job['progress'].get('state', 'queued'),
 
-    return jsonify({'error': 'Unauthorized'}), 403
+    'deleted_responses': job['progress'].get('deleted_responses', 0),
+
+    'error': job.get('error'),
+
+    'created_at': job['created_at'].isoformat(),
 
-  Form.delete(form_id)
+    'finished_at': job['finished_at'].isoformat() if job.get('finished_at') else None
 
-  return jsonify({'message': 'Form deleted successfully'}), 200
+  }), 200
 
 
 
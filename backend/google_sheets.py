@@ -1,13 +1,120 @@
 import os
 import json
+import bisect
+import threading
+import httplib2
 from google.oauth2.service_account import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from flask import current_app
+from sheets_scheduler import sheets_scheduler, PRIORITY_APPEND, PRIORITY_WRITE, PRIORITY_READ
+
+def column_letter(index):
+    """A1 letters for a zero-based column index (0 -> A, 26 -> AA)."""
+    letters = ''
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return letters
+
+
+def _stable_keys(columns, target):
+    """Keys of the longest run of target columns already in the right relative order.
+
+    Those columns stay where they are; every other column is moved or inserted.
+    """
+    position = {}
+    for i, column in enumerate(columns):
+        position.setdefault(column['key'], i)
+    seq = [position[key] for key, _ in target if key in position]
+    # Longest increasing subsequence of current positions
+    tails, tail_at, parent = [], [], [None] * len(seq)
+    for i, pos in enumerate(seq):
+        j = bisect.bisect_left(tails, pos)
+        parent[i] = tail_at[j - 1] if j else None
+        if j == len(tails):
+            tails.append(pos)
+            tail_at.append(i)
+        else:
+            tails[j] = pos
+            tail_at[j] = i
+    stable = set()
+    i = tail_at[-1] if tail_at else None
+    while i is not None:
+        stable.add(columns[seq[i]]['key'])
+        i = parent[i]
+    return stable
+
+
+def plan_columns(properties, columns, target):
+    """batchUpdate requests that turn the tab's `columns` into `target`.
+
+    `columns` is the current column map ([{'key', 'label'}], one per sheet
+    column); `target` lists (key, label) in field order. Columns are moved
+    rather than rewritten, so existing rows stay aligned with their header;
+    columns of removed fields are left in place. Returns (requests, new map).
+    """
+    sheet_id = properties['sheetId']
+    cols = [dict(column) for column in columns]
+    keys = [column['key'] for column in cols]
+    stable = _stable_keys(cols, target)
+    requests = []
+    inserted = 0
+    prev = None
+    for key, label in target:
+        if key not in stable:
+            dest = keys.index(prev) + 1 if prev is not None else 0
+            if key in keys:
+                src = keys.index(key)
+                if src != dest:
+                    requests.append({'moveDimension': {
+                        'source': {'sheetId': sheet_id, 'dimension': 'COLUMNS',
+                                   'startIndex': src, 'endIndex': src + 1},
+                        'destinationIndex': dest
+                    }})
+                    column = cols.pop(src)
+                    keys.pop(src)
+                    # destinationIndex counts the moved column; the list no longer does
+                    dest = dest - 1 if src < dest else dest
+                    cols.insert(dest, column)
+                    keys.insert(dest, key)
+            else:
+                if dest < len(cols):
+                    # Past the last used column there is nothing to shift
+                    requests.append({'insertDimension': {
+                        'range': {'sheetId': sheet_id, 'dimension': 'COLUMNS',
+                                  'startIndex': dest, 'endIndex': dest + 1},
+                        'inheritFromBefore': dest > 0
+                    }})
+                    inserted += 1
+                cols.insert(dest, {'key': key, 'label': label})
+                keys.insert(dest, key)
+        cols[keys.index(key)]['label'] = label
+        prev = key
+
+    if requests or [c['label'] for c in cols] != [c['label'] for c in columns]:
+        column_count = properties.get('gridProperties', {}).get('columnCount', 26) + inserted
+        if len(cols) > column_count:
+            requests.insert(0, {'appendDimension': {
+                'sheetId': sheet_id, 'dimension': 'COLUMNS', 'length': len(cols) - column_count
+            }})
+        requests.append({'updateCells': {
+            'range': {'sheetId': sheet_id, 'startRowIndex': 0, 'endRowIndex': 1,
+                      'startColumnIndex': 0, 'endColumnIndex': len(cols)},
+            'rows': [{'values': [{'userEnteredValue': {'stringValue': c['label']}} for c in cols]}],
+            'fields': 'userEnteredValue'
+        }})
+    return requests, cols
+
 
 class GoogleSheetsService:
     def __init__(self):
+        self.credentials = None
+        self._local = threading.local()
         self.service = self._initialize_service()
+        sheets_scheduler.start(current_app.config)
     
     def _initialize_service(self):
         """Initialize the Google Sheets API service with proper error handling."""
@@ -19,32 +126,46 @@ class GoogleSheetsService:
             raise FileNotFoundError(f'Credentials file not found at {SERVICE_ACCOUNT_FILE}')
             
         try:
-            creds = Credentials.from_service_account_file(
+            self.credentials = Credentials.from_service_account_file(
                 SERVICE_ACCOUNT_FILE, 
                 scopes=SCOPES
             )
-            return build('sheets', 'v4', credentials=creds)
+            return build('sheets', 'v4', credentials=self.credentials)
         except Exception as e:
             current_app.logger.error('Failed to initialize Google Sheets service: %s', str(e))
             raise
 
+    def _http(self):
+        """httplib2 is not thread-safe, so each scheduler thread gets its own connection."""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=30))
+        return http
+
+    def execute(self, request, spreadsheet_id, priority=PRIORITY_WRITE):
+        """Run an API request through the quota-aware scheduler."""
+        return sheets_scheduler.run(lambda: request.execute(http=self._http()), spreadsheet_id, priority)
+
     def ensure_sheet_exists(self, spreadsheet_id, sheet_name):
         """Ensure the specified sheet exists in the spreadsheet."""
+        self.sheet_properties(spreadsheet_id, sheet_name)
+
+    def sheet_properties(self, spreadsheet_id, sheet_name):
+        """Return (properties, created) for a tab, creating it when missing."""
         try:
-            spreadsheet = self.service.spreadsheets().get(
-                spreadsheetId=spreadsheet_id
-            ).execute()
-            
-            sheets = spreadsheet.get('sheets', [])
-            sheet_exists = any(sheet['properties']['title'] == sheet_name for sheet in sheets)
-            
-            if not sheet_exists:
-                self._create_sheet(spreadsheet_id, sheet_name)
-                
+            spreadsheet = self.execute(self.service.spreadsheets().get(
+                spreadsheetId=spreadsheet_id,
+                fields='sheets.properties'
+            ), spreadsheet_id, PRIORITY_READ)
         except HttpError as e:
             current_app.logger.error('Error checking sheet existence: %s', str(e))
             raise
 
+        for sheet in spreadsheet.get('sheets', []):
+            if sheet['properties']['title'] == sheet_name:
+                return sheet['properties'], False
+        return self._create_sheet(spreadsheet_id, sheet_name), True
+
     def _create_sheet(self, spreadsheet_id, sheet_name):
         """Create a new sheet in the spreadsheet."""
         body = {
@@ -56,50 +177,116 @@ class GoogleSheetsService:
                 }
             }]
         }
-        self.service.spreadsheets().batchUpdate(
+        result = self.execute(self.service.spreadsheets().batchUpdate(
             spreadsheetId=spreadsheet_id,
             body=body
-        ).execute()
+        ), spreadsheet_id)
+        return result['replies'][0]['addSheet']['properties']
 
-    def write_headers(self, spreadsheet_id, sheet_name, headers):
-        """Write headers to the sheet if they don't exist."""
-        try:
-            range_name = f'{sheet_name}!A1:Z1'
-            result = self.service.spreadsheets().values().get(
-                spreadsheetId=spreadsheet_id,
-                range=range_name
-            ).execute()
-            
-            values = result.get('values', [])
-            if not values or values[0] != headers:
-                body = {'values': [headers]}
-                self.service.spreadsheets().values().update(
+    def rename_sheet(self, spreadsheet_id, old_name, new_name):
+        """Rename a tab. Returns False if no tab called `old_name` exists."""
+        spreadsheet = self.execute(self.service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id
+        ), spreadsheet_id, PRIORITY_READ)
+        for sheet in spreadsheet.get('sheets', []):
+            if sheet['properties']['title'] == old_name:
+                body = {
+                    'requests': [{
+                        'updateSheetProperties': {
+                            'properties': {
+                                'sheetId': sheet['properties']['sheetId'],
+                                'title': new_name
+                            },
+                            'fields': 'title'
+                        }
+                    }]
+                }
+                self.execute(self.service.spreadsheets().batchUpdate(
                     spreadsheetId=spreadsheet_id,
-                    range=range_name,
-                    valueInputOption='USER_ENTERED',
                     body=body
-                ).execute()
-        except HttpError as e:
-            if e.resp.status == 404:
-                self.ensure_sheet_exists(spreadsheet_id, sheet_name)
-                self.write_headers(spreadsheet_id, sheet_name, headers)
+                ), spreadsheet_id)
+                return True
+        return False
+
+    def ensure_tab(self, spreadsheet_id, sheet_name, headers):
+        """Make sure a tab exists; one created here gets `headers` as its first row.
+
+        Unlike sync_headers this never moves columns of an existing tab, so
+        concurrent requests can call it. Returns True when the tab was created.
+        """
+        properties, created = self.sheet_properties(spreadsheet_id, sheet_name)
+        if created:
+            # Positions as keys: labels may repeat
+            requests, _ = plan_columns(properties, [], list(enumerate(headers)))
+            if requests:
+                self.execute(self.service.spreadsheets().batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body={'requests': requests}
+                ), spreadsheet_id)
+        return created
+
+    def sync_headers(self, spreadsheet_id, sheet_name, target, known=None, heartbeat=None):
+        """Line the tab's columns up with `target`, a list of (key, label) in field order.
+
+        The header row is read over the tab's real width and matched to keys
+        through `known`, the column map stored for the tab, falling back to
+        labels for sheets written before column maps existed. The column
+        moves, inserts and header write are sent in a single batchUpdate, and
+        nothing is written when the tab already matches. Returns the new map.
+
+        Column moves are not idempotent: only one sync may run per tab at a
+        time, which is why only the provisioning job calls this. `heartbeat`
+        is called between API calls so the job keeps its lease.
+        """
+        heartbeat = heartbeat or (lambda: None)
+        properties, created = self.sheet_properties(spreadsheet_id, sheet_name)
+        heartbeat()
+        header = []
+        if not created:
+            column_count = properties.get('gridProperties', {}).get('columnCount', 26)
+            result = self.execute(self.service.spreadsheets().values().get(
+                spreadsheetId=spreadsheet_id,
+                range=f'{sheet_name}!A1:{column_letter(column_count - 1)}1'
+            ), spreadsheet_id, PRIORITY_READ)
+            values = result.get('values', [])
+            header = values[0] if values else []
+            heartbeat()
+
+        by_label = {label: key for key, label in target}
+        columns = []
+        for i, label in enumerate(header):
+            if known and i < len(known) and known[i]['label'] == label:
+                key = known[i]['key']
             else:
-                raise
+                key = by_label.get(label, label)
+            columns.append({'key': key, 'label': label})
+
+        requests, columns = plan_columns(properties, columns, target)
+        if requests:
+            self.execute(self.service.spreadsheets().batchUpdate(
+                spreadsheetId=spreadsheet_id,
+                body={'requests': requests}
+            ), spreadsheet_id)
+        return columns
 
     def append_data(self, spreadsheet_id, sheet_name, data):
         """Append data to the specified sheet with comprehensive error handling."""
+        return self.append_rows(spreadsheet_id, sheet_name, [data])
+
+    def append_rows(self, spreadsheet_id, sheet_name, rows):
+        """Append several rows in a single API call."""
         try:
             body = {
-                'values': [data],
+                'values': rows,
                 'majorDimension': 'ROWS'
             }
-            result = self.service.spreadsheets().values().append(
+            result = self.execute(self.service.spreadsheets().values().append(
                 spreadsheetId=spreadsheet_id,
                 range=f'{sheet_name}!A1',
                 valueInputOption='USER_ENTERED',
                 insertDataOption='INSERT_ROWS',
                 body=body
-            ).execute()
+            ), spreadsheet_id, PRIORITY_APPEND)
             return result
         except HttpError as e:
             error_details = json.loads(e.content.decode())
@@ -0,0 +1,147 @@
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from functools import wraps
+
+from bson.objectid import ObjectId
+from flask import request, jsonify, make_response, Response
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from models import mongo
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+
+
+class IdempotencyKeys:
+    """`Idempotency-Key` support for the submission endpoint.
+
+    The first request with a key claims it by inserting a placeholder under a
+    unique (form_id, key) index; when it finishes, its status and body are
+    stored on that document. Retries with the same key get the stored result
+    back without running the view again, so no second response is inserted
+    and no second row is appended to the sheet. Keys expire after
+    IDEMPOTENCY_TTL_HOURS. A claim older than IDEMPOTENCY_LOCK_SECONDS is taken
+    over; each claim carries a token, so only the request holding it can
+    complete or release the key.
+    """
+
+    def __init__(self):
+        self.enabled = False
+
+    @property
+    def collection(self):
+        return mongo.db.idempotency_keys
+
+    def init_app(self, app):
+        self.enabled = app.config.get('IDEMPOTENCY_ENABLED', True)
+        self.ttl = timedelta(hours=app.config.get('IDEMPOTENCY_TTL_HOURS', 24))
+        self.lock_timeout = timedelta(seconds=app.config.get('IDEMPOTENCY_LOCK_SECONDS', 120))
+
+    def ensure_indexes(self):
+        self.collection.create_index([('form_id', ASCENDING), ('key', ASCENDING)], unique=True)
+        self.collection.create_index('expire_at', expireAfterSeconds=0)
+
+    def _fingerprint(self):
+        if request.mimetype == 'multipart/form-data':
+            # Reading a multipart body here would buffer the uploads it streams to GridFS
+            return f'multipart:{request.content_length}'
+        return hashlib.sha256(request.get_data(cache=True)).hexdigest()
+
+    def _claim(self, form_id, key, fingerprint):
+        """Insert the placeholder; returns (claim token, None) when claimed, else (None, existing record)."""
+        now = datetime.utcnow()
+        for _ in range(2):
+            claim = ObjectId()
+            try:
+                self.collection.insert_one({
+                    'form_id': form_id,
+                    'key': key,
+                    'claim': claim,
+                    'fingerprint': fingerprint,
+                    'status': IN_PROGRESS,
+                    'created_at': now,
+                    'expire_at': now + self.ttl,
+                })
+                return claim, None
+            except DuplicateKeyError:
+                existing = self.collection.find_one({'form_id': form_id, 'key': key})
+                if existing is None:
+                    # Expired or released in between
+                    continue
+                if existing['status'] == IN_PROGRESS and now - existing['created_at'] > self.lock_timeout:
+                    # The worker handling it died; let this request take over
+                    self.collection.delete_one({'_id': existing['_id'], 'status': IN_PROGRESS})
+                    continue
+                return None, existing
+        return None, self.collection.find_one({'form_id': form_id, 'key': key})
+
+    def _replay(self, record, fingerprint):
+        if record['fingerprint'] != fingerprint:
+            return jsonify({'error': f'{HEADER} was already used with a different request'}), 422
+        if record['status'] == IN_PROGRESS:
+            response = jsonify({'error': 'A request with this key is still being processed'})
+            response.status_code = 409
+            response.headers['Retry-After'] = '1'
+            return response
+        response = Response(record['body'], status=record['status_code'], mimetype=record['mimetype'])
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    def idempotent(self, view):
+        @wraps(view)
+        def wrapper(form_id, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not self.enabled or not key or not ObjectId.is_valid(form_id):
+                return view(form_id, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return jsonify({'error': f'{HEADER} must be at most {MAX_KEY_LENGTH} characters'}), 400
+
+            form_oid = ObjectId(form_id)
+            fingerprint = self._fingerprint()
+            claim = None
+            try:
+                # Plain read first: replays are the common case on a retry storm
+                record = self.collection.find_one({'form_id': form_oid, 'key': key})
+                if record is None:
+                    claim, record = self._claim(form_oid, key, fingerprint)
+            except PyMongoError as e:
+                logger.error(f"Idempotency store unavailable: {str(e)}")
+                return jsonify({'error': 'Service unavailable, retry later'}), 503
+            if record is not None:
+                return self._replay(record, fingerprint)
+
+            response = None
+            try:
+                response = make_response(view(form_id, *args, **kwargs))
+            finally:
+                self._record(form_oid, key, claim, response)
+            return response
+        return wrapper
+
+    def _record(self, form_id, key, claim, response):
+        # Only the claim this request made: after a takeover the key belongs to the newer request
+        record_filter = {'form_id': form_id, 'key': key, 'claim': claim, 'status': IN_PROGRESS}
+        try:
+            if response is None or response.status_code >= 500 or response.status_code in (409, 429):
+                # Not a final outcome: free the key so a retry runs again
+                self.collection.delete_one(record_filter)
+                return
+            self.collection.update_one(record_filter, {'$set': {
+                'status': COMPLETED,
+                'status_code': response.status_code,
+                'mimetype': response.mimetype,
+                'body': response.get_data(as_text=True),
+                'completed_at': datetime.utcnow(),
+            }})
+        except PyMongoError as e:
+            logger.error(f"Could not record idempotency key for form {form_id}: {str(e)}")
+
+
+idempotency_keys = IdempotencyKeys()
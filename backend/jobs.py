@@ -0,0 +1,205 @@
+import logging
+import random
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument, ASCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from models import mongo
+
+logger = logging.getLogger(__name__)
+
+
+def _now():
+    # MongoDB keeps milliseconds; truncate so lease values compare equal on read back
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+class LeaseLost(Exception):
+    """The job's lease ran out and another worker may have claimed it."""
+
+
+class JobQueue:
+    """Persistent background job queue stored in the `jobs` collection.
+
+    Workers claim jobs with a lease. A job whose worker dies (restart, crash)
+    becomes claimable again once its lease runs out, so handlers must be safe
+    to resume: they should pick up from the progress they recorded.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.app = None
+        self._wakeup = threading.Event()
+        self._threads = []
+
+    def handler(self, job_type):
+        def decorator(fn):
+            self.handlers[job_type] = fn
+            return fn
+        return decorator
+
+    @property
+    def collection(self):
+        return mongo.db.jobs
+
+    def init_app(self, app):
+        self.app = app
+        self.lease_seconds = app.config.get('JOBS_LEASE_SECONDS', 60)
+        self.max_attempts = app.config.get('JOBS_MAX_ATTEMPTS', 5)
+        self.poll_interval = app.config.get('JOBS_POLL_INTERVAL', 2.0)
+        self.retention = timedelta(days=app.config.get('JOBS_RETENTION_DAYS', 7))
+
+        if not app.config.get('JOBS_ENABLED', True):
+            return
+        for i in range(app.config.get('JOBS_WORKER_THREADS', 2)):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def ensure_indexes(self):
+        self.collection.create_index([('status', ASCENDING), ('run_at', ASCENDING)])
+        self.collection.create_index([('type', ASCENDING), ('payload.form_id', ASCENDING)])
+        # At most one active job per key; finished jobs drop the flag
+        self.collection.create_index('key', unique=True, partialFilterExpression={'active': True})
+        self.collection.create_index('expire_at', expireAfterSeconds=0)
+
+    def enqueue(self, job_type, payload, key=None, delay=0):
+        """Queue a job and return its id.
+
+        With a key, an already active job for that key is reused instead; if
+        it is running it is flagged to run once more after it finishes.
+        """
+        now = _now()
+        job = {
+            'type': job_type,
+            'payload': payload,
+            'status': 'pending',
+            'active': True,
+            'attempts': 0,
+            'progress': {},
+            'run_at': now + timedelta(seconds=delay),
+            'created_at': now,
+        }
+        if key:
+            job['key'] = key
+        try:
+            job_id = self.collection.insert_one(job).inserted_id
+        except DuplicateKeyError:
+            existing = self.collection.find_one_and_update(
+                {'key': key, 'active': True},
+                {'$set': {'rerun': True}},
+                projection={'_id': 1}
+            )
+            if not existing:
+                # The active job finished in between; queue a fresh one
+                return self.enqueue(job_type, payload, key, delay)
+            job_id = existing['_id']
+        self._wakeup.set()
+        return job_id
+
+    def find_latest(self, job_type, form_id):
+        return self.collection.find_one(
+            {'type': job_type, 'payload.form_id': str(form_id)},
+            sort=[('created_at', -1)]
+        )
+
+    def heartbeat(self, job, **progress):
+        """Record progress and extend the lease of a running job.
+
+        Raises LeaseLost when the lease already ran out and the job was
+        claimed again, so the handler stops instead of racing the new run.
+        """
+        lease_until = _now() + timedelta(seconds=self.lease_seconds)
+        updates = {'lease_until': lease_until}
+        for name, value in progress.items():
+            updates[f'progress.{name}'] = value
+            job['progress'][name] = value
+        result = self.collection.update_one({'_id': job['_id'], 'lease_until': job['lease_until']}, {'$set': updates})
+        if not result.matched_count:
+            raise LeaseLost(f"Job {job['_id']} lost its lease")
+        job['lease_until'] = lease_until
+
+    def _claim(self):
+        now = _now()
+        return self.collection.find_one_and_update(
+            {
+                'status': {'$in': ['pending', 'running']},
+                'run_at': {'$lte': now},
+                '$or': [{'lease_until': None}, {'lease_until': {'$lt': now}}],
+            },
+            {
+                '$set': {
+                    'status': 'running',
+                    'lease_until': now + timedelta(seconds=self.lease_seconds),
+                    'started_at': now,
+                    'rerun': False,
+                },
+                '$inc': {'attempts': 1},
+            },
+            sort=[('run_at', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _finish(self, job, error=None):
+        now = _now()
+        job_filter = {'_id': job['_id'], 'lease_until': job['lease_until']}
+        if error is None:
+            # Work was queued for this key while we ran: go around again
+            rerun = self.collection.update_one(
+                dict(job_filter, rerun=True),
+                {'$set': {'status': 'pending', 'attempts': 0, 'run_at': now, 'lease_until': None}}
+            )
+            if rerun.modified_count:
+                return
+            self.collection.update_one(job_filter, {
+                '$set': {'status': 'done', 'finished_at': now, 'expire_at': now + self.retention},
+                '$unset': {'active': '', 'lease_until': ''}
+            })
+        elif job['attempts'] < self.max_attempts:
+            backoff = min(600, 2 ** job['attempts']) * random.uniform(0.5, 1.5)
+            self.collection.update_one(job_filter, {'$set': {
+                'status': 'pending',
+                'error': error,
+                'run_at': now + timedelta(seconds=backoff),
+                'lease_until': None,
+            }})
+        else:
+            self.collection.update_one(job_filter, {
+                '$set': {'status': 'failed', 'error': error, 'finished_at': now,
+                         'expire_at': now + self.retention},
+                '$unset': {'active': '', 'lease_until': ''}
+            })
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except PyMongoError as e:
+                logger.error(f"Job queue unavailable: {str(e)}")
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        handler = self.handlers.get(job['type'])
+        try:
+            if handler is None:
+                raise RuntimeError(f"No handler registered for job type {job['type']}")
+            with self.app.app_context():
+                handler(job)
+        except Exception as e:
+            logger.error(f"Job {job['_id']} ({job['type']}) failed: {str(e)}")
+            logger.debug(traceback.format_exc())
+            self._finish(job, error=str(e))
+        else:
+            self._finish(job)
+
+
+job_queue = JobQueue()
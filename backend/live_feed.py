@@ -0,0 +1,194 @@
+import json
+import logging
+import queue
+import threading
+from collections import deque
+
+from bson.objectid import ObjectId
+from pymongo.errors import PyMongoError, OperationFailure
+
+from models import mongo
+
+logger = logging.getLogger(__name__)
+
+
+def encode_token(token):
+    # Resume tokens are {'_data': <hex string>}; the string alone makes a compact SSE id
+    return token['_data']
+
+
+def decode_token(value):
+    return {'_data': value}
+
+
+def _event(change):
+    doc = change['fullDocument']
+    return {
+        'id': encode_token(change['_id']),
+        'form_id': str(doc['form_id']),
+        'data': {
+            '_id': str(doc['_id']),
+            'form_id': str(doc['form_id']),
+            'data': doc.get('data', {}),
+            'submitted_at': doc['submitted_at'].isoformat() + 'Z',
+        },
+    }
+
+
+class ResponseFeed:
+    """One change stream on `responses` per worker, fanned out by form_id.
+
+    Subscribers get a bounded queue; a subscriber that falls too far behind
+    is dropped and reconnects with its last event id. The hub keeps a short
+    backlog so most reconnects replay from memory; an older resume token
+    is caught up on a short-lived private stream before the client joins
+    the shared one.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._backlog = deque()
+        self._resume_token = None
+        self._thread = None
+
+    def init_app(self, app):
+        self.queue_size = app.config.get('LIVE_FEED_QUEUE_SIZE', 100)
+        self.backlog = app.config.get('LIVE_FEED_BACKLOG', 1000)
+        self.heartbeat = app.config.get('LIVE_FEED_HEARTBEAT_SECONDS', 15)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name='response-feed', daemon=True)
+                self._thread.start()
+
+    def _pipeline(self, form_id=None):
+        match = {'operationType': 'insert'}
+        if form_id:
+            match['fullDocument.form_id'] = form_id
+        return [{'$match': match}]
+
+    def _watch(self):
+        while True:
+            try:
+                with mongo.db.responses.watch(self._pipeline(), resume_after=self._resume_token) as stream:
+                    for change in stream:
+                        self._resume_token = change['_id']
+                        self._publish(_event(change))
+            except OperationFailure as e:
+                # Resume point no longer in the oplog: continue from now
+                logger.error(f"Response change stream could not resume, restarting: {str(e)}")
+                self._resume_token = None
+                threading.Event().wait(1)
+            except PyMongoError as e:
+                logger.error(f"Response change stream interrupted, resuming: {str(e)}")
+                threading.Event().wait(1)
+
+    def _publish(self, event):
+        with self._lock:
+            self._backlog.append(event)
+            if len(self._backlog) > self.backlog:
+                self._backlog.popleft()
+            subscribers = list(self._subscribers.get(event['form_id'], ()))
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # Slow consumer: tell it to reconnect from its last event id
+                self._drop(event['form_id'], q)
+
+    def _drop(self, form_id, q):
+        with self._lock:
+            self._subscribers.get(form_id, set()).discard(q)
+        # The queue is full; empty it so the close sentinel fits. Only this
+        # thread publishes and the queue is unsubscribed, so nothing refills it.
+        while True:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                break
+        q.put_nowait(None)
+
+    def subscribe(self, form_id, last_event_id=None):
+        """Register a subscriber; returns (queue, replay events) or (None, None) if
+        the last event id is not in the backlog and needs a private stream."""
+        self._ensure_started()
+        q = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            replay = []
+            if last_event_id:
+                ids = [e['id'] for e in self._backlog]
+                if last_event_id not in ids:
+                    return None, None
+                replay = [e for e in list(self._backlog)[ids.index(last_event_id) + 1:]
+                          if e['form_id'] == form_id]
+            self._subscribers.setdefault(form_id, set()).add(q)
+        return q, replay
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(s) for s in self._subscribers.values())
+
+    def unsubscribe(self, form_id, q):
+        with self._lock:
+            subscribers = self._subscribers.get(form_id)
+            if subscribers is not None:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self._subscribers[form_id]
+
+    def stream(self, form_id, last_event_id=None):
+        """Yield SSE-formatted text for new responses to `form_id`."""
+        yield 'retry: 3000\n\n'
+        q, replay = self.subscribe(form_id, last_event_id)
+        catch_up = q is None
+        caught_up = set()
+        if catch_up:
+            # Older than the backlog: join the hub first so nothing is missed,
+            # then catch up on a private stream and hand over to the hub queue
+            q, replay = self.subscribe(form_id)
+        try:
+            if catch_up:
+                try:
+                    for event in self._catch_up(form_id, last_event_id):
+                        caught_up.add(event['id'])
+                        yield _format(event)
+                except PyMongoError as e:
+                    # Token too old for the oplog: the client starts over from now
+                    logger.warning(f"Could not resume response feed for form {form_id}: {str(e)}")
+                    yield 'event: reset\ndata: {}\n\n'
+            for event in replay:
+                yield _format(event)
+            while True:
+                try:
+                    event = q.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if event is None:
+                    return
+                if event['id'] in caught_up:
+                    # Already sent during the catch-up
+                    continue
+                yield _format(event)
+        finally:
+            self.unsubscribe(form_id, q)
+
+    def _catch_up(self, form_id, last_event_id):
+        """Events after `last_event_id` up to now, read from a short-lived private stream."""
+        with mongo.db.responses.watch(self._pipeline(ObjectId(form_id)),
+                                      resume_after=decode_token(last_event_id),
+                                      max_await_time_ms=1000) as stream:
+            while stream.alive:
+                change = stream.try_next()
+                if change is None:
+                    return
+                yield _event(change)
+
+
+def _format(event):
+    return f"id: {event['id']}\nevent: response\ndata: {json.dumps(event['data'], default=str)}\n\n"
+
+
+response_feed = ResponseFeed()
@@ -2,10 +2,100 @@ from flask_pymongo import PyMongo
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 import os
+from contextlib import contextmanager
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, TEXT, ReadPreference, ReturnDocument
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Secondary, SecondaryPreferred, Nearest
+from write_combiner import InsertCombiner
 
 mongo = PyMongo()
 
+# Read routing. Submission and ownership checks read from the primary;
+# dashboard listings and analytics tolerate slight staleness and are sent
+# to secondaries so they don't compete with writes. update_form reads its
+# own write back from the primary (find_one_and_update); the dashboard reads
+# from secondaries in a causally consistent session advanced past the
+# owner's last form write, so a form just saved is never missing from it.
+READ_PRIMARY = 'primary'
+READ_ANALYTICS = 'analytics'
+READ_CONSISTENT = 'consistent'
+
+_SECONDARY_MODES = {
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+_read_profiles = {
+    READ_PRIMARY: (ReadPreference.PRIMARY, ReadConcern('local')),
+    READ_ANALYTICS: (ReadPreference.SECONDARY_PREFERRED, ReadConcern('local')),
+    READ_CONSISTENT: (ReadPreference.SECONDARY_PREFERRED, ReadConcern('majority')),
+}
+
+
+def init_read_routing(app):
+    mode = app.config.get('MONGO_ANALYTICS_READ_PREFERENCE', 'secondaryPreferred')
+    if mode == 'primary':
+        preference = ReadPreference.PRIMARY
+    else:
+        preference = _SECONDARY_MODES[mode](
+            max_staleness=app.config.get('MONGO_ANALYTICS_MAX_STALENESS', -1)
+        )
+    _read_profiles[READ_ANALYTICS] = (preference, ReadConcern('local'))
+    _read_profiles[READ_CONSISTENT] = (preference, ReadConcern('majority'))
+
+
+def collection(name, read=READ_PRIMARY):
+    """Collection handle carrying the read preference and concern for `read`."""
+    read_preference, read_concern = _read_profiles[read]
+    return mongo.db.get_collection(name, read_preference=read_preference, read_concern=read_concern)
+
+
+@contextmanager
+def consistent_session(after=None):
+    """Causally consistent session; reads in it see every write up to operation time `after`."""
+    with mongo.cx.start_session(causal_consistency=True) as session:
+        if after is not None:
+            session.advance_operation_time(after)
+        yield session
+
+
+@contextmanager
+def recorded_form_write(user_id):
+    """Session for a write to one of `user_id`'s forms.
+
+    Afterwards the write's operation time is kept on the user, where
+    Form.dashboard_session picks it up for the next listing.
+    """
+    with mongo.cx.start_session(causal_consistency=True) as session:
+        yield session
+        if session.operation_time is not None:
+            mongo.db.users.update_one(
+                {'_id': ObjectId(user_id)},
+                {'$max': {'forms_written_at': session.operation_time}}
+            )
+
+
+def ensure_indexes():
+    """Create the indexes the queries below rely on (no-op when they exist)."""
+    mongo.db.forms.create_index([('user_id', ASCENDING), ('deleted_at', ASCENDING)])
+    # Drives per-form listing and the batched purge after a form is deleted
+    mongo.db.responses.create_index([('form_id', ASCENDING), ('submitted_at', ASCENDING), ('_id', ASCENDING)])
+    # Response search: free text scoped to one form, and exact matches on field values
+    mongo.db.responses.create_index([('form_id', ASCENDING), ('$**', TEXT)], name='form_id_text')
+    mongo.db.responses.create_index([('data.$**', ASCENDING)])
+    # Only imported responses; an earlier sparse version indexed every response
+    import_index = mongo.db.responses.index_information().get('import_id_1__id_1')
+    if import_index and 'partialFilterExpression' not in import_index:
+        mongo.db.responses.drop_index('import_id_1__id_1')
+    mongo.db.responses.create_index([('import_id', ASCENDING), ('_id', ASCENDING)],
+                                    partialFilterExpression={'import_id': {'$exists': True}})
+    mongo.db['uploads.files'].create_index('metadata.form_id')
+    # Outbound webhook queue: pending deliveries per endpoint, delivered ones expire
+    mongo.db.webhook_deliveries.create_index([('form_id', ASCENDING), ('url', ASCENDING), ('status', ASCENDING), ('_id', ASCENDING)])
+    mongo.db.webhook_deliveries.create_index('expire_at', expireAfterSeconds=0)
+
 class User:
     @staticmethod
     def find_by_id(user_id):
@@ -46,30 +136,95 @@ class Form:
         }
         if google_sheet_name:
             doc['google_sheet_name'] = google_sheet_name
-        return mongo.db.forms.insert_one(doc)
+        with recorded_form_write(user_id) as session:
+            return mongo.db.forms.insert_one(doc, session=session)
 
     @staticmethod
-    def find_by_user(user_id):
-        return list(mongo.db.forms.find({'user_id': ObjectId(user_id)}))
+    def find_by_user(user_id, read=READ_ANALYTICS, session=None):
+        return list(collection('forms', read).find({'user_id': ObjectId(user_id), 'deleted_at': None},
+                                                   session=session))
 
     @staticmethod
-    def find_by_id(form_id):
-        return mongo.db.forms.find_one({'_id': ObjectId(form_id)})
+    @contextmanager
+    def dashboard_session(user_id):
+        """Session for READ_CONSISTENT reads that include the user's latest form writes."""
+        user = mongo.db.users.find_one({'_id': ObjectId(user_id)}, {'forms_written_at': 1}) or {}
+        with consistent_session(user.get('forms_written_at')) as session:
+            yield session
 
     @staticmethod
-    def update(form_id, updates):
+    def find_by_id(form_id, read=READ_PRIMARY):
+        return collection('forms', read).find_one({'_id': ObjectId(form_id), 'deleted_at': None})
+
+    @staticmethod
+    def update_owned(form_id, user_id, updates):
+        """Update a form owned by `user_id` and return the new document in one round trip.
+
+        Returns None when there is no such form for that owner. When the sheet
+        name changes, the tab's current name is kept in `sheet_rename_from`
+        until the background rename has been applied to the spreadsheet.
+        """
         updates['updated_at'] = datetime.utcnow()
-        # If google_sheet_name is in updates or in settings, set it at the top level
         google_sheet_name = updates.get('google_sheet_name')
         if not google_sheet_name and 'settings' in updates:
             google_sheet_name = updates['settings'].get('google_sheet_name')
         if google_sheet_name:
             updates['google_sheet_name'] = google_sheet_name
+
+        pipeline = []
+        if google_sheet_name:
+            pipeline.append({'$set': {'sheet_rename_from': {'$let': {
+                'vars': {'tab': {'$ifNull': ['$sheet_rename_from', '$google_sheet_name']}},
+                'in': {'$cond': [
+                    {'$or': [{'$eq': ['$$tab', None]}, {'$eq': ['$$tab', google_sheet_name]}]},
+                    '$$REMOVE',
+                    '$$tab'
+                ]}
+            }}}})
+        # $literal keeps user-supplied values from being read as expressions
+        pipeline.append({'$set': {key: {'$literal': value} for key, value in updates.items()}})
+        with recorded_form_write(user_id) as session:
+            return mongo.db.forms.find_one_and_update(
+                {'_id': ObjectId(form_id), 'user_id': ObjectId(user_id), 'deleted_at': None},
+                pipeline,
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+
+    @staticmethod
+    def finish_sheet_rename(form_id, renamed_from, renamed_to):
+        """Record that the tab was renamed, unless the title changed again meanwhile."""
+        return mongo.db.forms.update_one(
+            {'_id': ObjectId(form_id), 'sheet_rename_from': renamed_from},
+            [{'$set': {'sheet_rename_from': {'$cond': [
+                {'$eq': ['$google_sheet_name', renamed_to]}, '$$REMOVE', renamed_to
+            ]}}}]
+        )
+
+    @staticmethod
+    def set_sheet_provisioning(form_id, provisioning):
+        return mongo.db.forms.update_one(
+            {'_id': ObjectId(form_id)},
+            {'$set': {'sheet_provisioning': provisioning}}
+        )
+
+    @staticmethod
+    def set_sheet_columns(form_id, sheet_columns):
         return mongo.db.forms.update_one(
             {'_id': ObjectId(form_id)},
-            {'$set': updates}
+            {'$set': {'sheet_columns': sheet_columns}}
         )
 
+    @staticmethod
+    def mark_deleted(form_id, user_id):
+        """Hide the form right away; its responses are purged in the background."""
+        with recorded_form_write(user_id) as session:
+            return mongo.db.forms.update_one(
+                {'_id': ObjectId(form_id), 'deleted_at': None},
+                {'$set': {'deleted_at': datetime.utcnow()}},
+                session=session
+            )
+
     @staticmethod
     def delete(form_id):
         return mongo.db.forms.delete_one({'_id': ObjectId(form_id)})
@@ -95,12 +250,15 @@ class Template:
 
     @staticmethod
     def find_all():
-        return list(mongo.db.templates.find())
+        return list(collection('templates', READ_ANALYTICS).find())
+
+# Response inserts from concurrent submissions are group-committed
+response_writer = InsertCombiner(lambda: mongo.db.responses)
 
 class Response:
     @staticmethod
     def create(form_id, data):
-        return mongo.db.responses.insert_one({
+        return response_writer.insert_one({
             'form_id': ObjectId(form_id),
             'data': data,
             'submitted_at': datetime.utcnow()
@@ -108,4 +266,34 @@ class Response:
 
     @staticmethod
     def find_by_form(form_id):
-        return list(mongo.db.responses.find({'form_id': ObjectId(form_id)}))
\ No newline at end of file
+        return list(collection('responses', READ_ANALYTICS).find({'form_id': ObjectId(form_id)}))
+
+    @staticmethod
+    def search(form_id, start=None, end=None, filters=None, text=None, after=None, limit=50):
+        """Newest-first page of a form's responses matching the given criteria.
+
+        `filters` maps alternative data keys to accepted values, e.g.
+        {('email', 'Email'): ['a@b.c']}. `after` is the (submitted_at, _id) of
+        the last response on the previous page.
+        """
+        clauses = [{'form_id': ObjectId(form_id)}]
+        if start or end:
+            date_range = {}
+            if start:
+                date_range['$gte'] = start
+            if end:
+                date_range['$lt'] = end
+            clauses.append({'submitted_at': date_range})
+        for keys, values in (filters or {}).items():
+            clauses.append({'$or': [{f'data.{key}': {'$in': values}} for key in keys]})
+        if text:
+            clauses.append({'$text': {'$search': text}})
+        if after:
+            submitted_at, last_id = after
+            clauses.append({'$or': [
+                {'submitted_at': {'$lt': submitted_at}},
+                {'submitted_at': submitted_at, '_id': {'$lt': last_id}}
+            ]})
+        return list(collection('responses', READ_ANALYTICS).find({'$and': clauses})
+                    .sort([('submitted_at', DESCENDING), ('_id', DESCENDING)])
+                    .limit(limit))
@@ -0,0 +1,205 @@
+import cProfile
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+from flask import Blueprint, g, request, jsonify, send_from_directory
+from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
+
+logger = logging.getLogger(__name__)
+
+profiles_bp = Blueprint('profiles', __name__)
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_MODES = ('cprofile', 'sample')
+
+
+class _StackSampler:
+    """Samples one thread's stack at a fixed interval into folded-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def dump(self, path):
+        # Folded format, readable by flamegraph.pl and speedscope
+        with open(path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class RequestProfiler:
+    """Opt-in per-request CPU profiling and allocation tracing.
+
+    A request is profiled when an admin asks for it with the `X-Profile`
+    header or `?profile=` query argument (`cprofile` or `sample`), or when it
+    falls on a route's 1-in-N sample. Results are written to PROFILING_DIR
+    and served from /api/internal/profiles. When PROFILING_ENABLED is off no
+    hooks are registered at all.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._trace_lock = threading.Lock()
+        self._counters = {}
+
+    def init_app(self, app):
+        config = app.config
+        if not config.get('PROFILING_ENABLED', False):
+            return
+        self.enabled = True
+        self.directory = config.get('PROFILING_DIR', '/tmp/form-profiles')
+        self.admins = set(config.get('PROFILING_ADMINS', []))
+        self.sample_rates = config.get('PROFILING_SAMPLE_RATES', {})
+        self.sample_interval = config.get('PROFILING_SAMPLE_INTERVAL_MS', 5) / 1000.0
+        self.max_files = config.get('PROFILING_MAX_FILES', 200)
+        self._counters = {endpoint: itertools.count(1) for endpoint in self.sample_rates}
+        os.makedirs(self.directory, exist_ok=True)
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.register_blueprint(profiles_bp, url_prefix='/api/internal/profiles')
+
+    def is_admin(self):
+        try:
+            verify_jwt_in_request(optional=True)
+        except Exception:
+            return False
+        identity = get_jwt_identity()
+        if not identity:
+            return False
+        if identity in self.admins:
+            return True
+        from models import User
+        user = User.find_by_id(identity)
+        return bool(user and user.get('email') in self.admins)
+
+    def _requested_mode(self):
+        mode = request.headers.get(PROFILE_HEADER) or request.args.get('profile')
+        if not mode:
+            return None
+        mode = mode.lower()
+        if mode not in PROFILE_MODES:
+            mode = 'cprofile'
+        return mode if self.is_admin() else None
+
+    def _sampled(self):
+        rate = self.sample_rates.get(request.endpoint)
+        return bool(rate) and next(self._counters[request.endpoint]) % rate == 0
+
+    def _before_request(self):
+        mode = self._requested_mode()
+        if mode is None and self._sampled():
+            mode = 'cprofile'
+        if mode is None:
+            return
+
+        state = {'mode': mode, 'started': time.perf_counter(), 'tracing': False}
+        # tracemalloc is process-wide, so only one request is traced at a time
+        if self._trace_lock.acquire(blocking=False):
+            tracemalloc.start(25)
+            state['tracing'] = True
+        if mode == 'sample':
+            state['sampler'] = _StackSampler(threading.get_ident(), self.sample_interval)
+            state['sampler'].start()
+        else:
+            state['profiler'] = cProfile.Profile()
+            state['profiler'].enable()
+        g._profile = state
+
+    def _after_request(self, response):
+        state = g.pop('_profile', None)
+        if state is None:
+            return response
+        profile_id = self._collect(state)
+        if profile_id:
+            response.headers['X-Profile-Id'] = profile_id
+        return response
+
+    def _teardown_request(self, exc):
+        # after_request does not run when the view raised
+        state = g.pop('_profile', None)
+        if state is not None:
+            self._collect(state)
+
+    def _collect(self, state):
+        snapshot = None
+        if 'profiler' in state:
+            state['profiler'].disable()
+        else:
+            state['sampler'].stop()
+        if state['tracing']:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self._trace_lock.release()
+
+        elapsed_ms = int((time.perf_counter() - state['started']) * 1000)
+        profile_id = f"{int(time.time())}-{request.endpoint or 'unknown'}-{elapsed_ms}ms-{uuid.uuid4().hex[:8]}"
+        base = os.path.join(self.directory, profile_id)
+        try:
+            if 'profiler' in state:
+                state['profiler'].dump_stats(base + '.prof')
+            else:
+                state['sampler'].dump(base + '.folded')
+            if snapshot is not None:
+                snapshot.dump(base + '.tracemalloc')
+                with open(base + '.alloc.txt', 'w') as f:
+                    for stat in snapshot.statistics('lineno')[:50]:
+                        f.write(f'{stat}\n')
+            self._prune()
+        except OSError as e:
+            logger.error(f"Failed to store profile {profile_id}: {str(e)}")
+            return None
+        logger.info(f"Stored profile {profile_id} for {request.method} {request.path}")
+        return profile_id
+
+    def _prune(self):
+        names = sorted(os.listdir(self.directory))
+        for name in names[:max(0, len(names) - self.max_files)]:
+            os.remove(os.path.join(self.directory, name))
+
+
+request_profiler = RequestProfiler()
+
+
+@profiles_bp.route('', methods=['GET'])
+def list_profiles():
+    if not request_profiler.is_admin():
+        return jsonify({'error': 'Unauthorized'}), 403
+    names = sorted(os.listdir(request_profiler.directory), reverse=True)
+    return jsonify({'profiles': names}), 200
+
+
+@profiles_bp.route('/<path:name>', methods=['GET'])
+def download_profile(name):
+    if not request_profiler.is_admin():
+        return jsonify({'error': 'Unauthorized'}), 403
+    return send_from_directory(request_profiler.directory, name, as_attachment=True)
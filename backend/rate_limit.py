@@ -0,0 +1,238 @@
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+
+from bson.objectid import ObjectId
+from flask import request, jsonify
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryLimiterStore:
+    """In-process token buckets. Only holds within a single worker."""
+
+    MAX_KEYS = 50000
+
+    def __init__(self):
+        self._buckets = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, capacity):
+        now = time.time()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0.0, now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.MAX_KEYS:
+                self._prune(now)
+        if allowed:
+            return 0
+        return (1 - tokens) / rate
+
+    def acquire_slot(self, key, limit, ttl):
+        with self._lock:
+            if self._slots.get(key, 0) >= limit:
+                return None
+            self._slots[key] = self._slots.get(key, 0) + 1
+        return key
+
+    def release_slot(self, key, lease):
+        with self._lock:
+            self._slots[key] -= 1
+
+    def _prune(self, now):
+        # A bucket idle long enough to be full again carries no state
+        idle = [k for k, (_, last) in self._buckets.items() if now - last > 3600]
+        for k in idle:
+            del self._buckets[k]
+
+
+class MongoLimiterStore:
+    """Token buckets kept in MongoDB so limits hold across gunicorn workers.
+
+    Each consume is a single atomic pipeline update on the bucket document.
+    """
+
+    def __init__(self, get_collection):
+        self._get_collection = get_collection
+        self._indexed = False
+
+    def _collection(self):
+        collection = self._get_collection()
+        if not self._indexed:
+            collection.create_index('expires_at', expireAfterSeconds=0)
+            self._indexed = True
+        return collection
+
+    def consume(self, key, rate, capacity):
+        now = time.time()
+        # Once a bucket has refilled completely the document is redundant
+        expires_at = datetime.utcnow() + timedelta(seconds=capacity / rate + 60)
+        refilled = {'$min': [capacity, {'$add': [
+            {'$ifNull': ['$tokens', capacity]},
+            {'$multiply': [{'$max': [0, {'$subtract': [now, {'$ifNull': ['$ts', now]}]}]}, rate]}
+        ]}]}
+        pipeline = [
+            {'$set': {'tokens': refilled, 'ts': now, 'expires_at': expires_at}},
+            {'$set': {'allowed': {'$gte': ['$tokens', 1]}}},
+            {'$set': {'tokens': {'$cond': ['$allowed', {'$subtract': ['$tokens', 1]}, '$tokens']}}},
+        ]
+        collection = self._collection()
+        try:
+            doc = collection.find_one_and_update(
+                {'_id': key}, pipeline, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Two workers created the same bucket at once; the retry finds it
+            doc = collection.find_one_and_update(
+                {'_id': key}, pipeline, return_document=ReturnDocument.AFTER
+            )
+        if doc['allowed']:
+            return 0
+        return (1 - doc['tokens']) / rate
+
+    def acquire_slot(self, key, limit, ttl):
+        """Take one of `limit` leases shared by all workers; returns the lease or None.
+
+        Leases expire after `ttl` seconds, so a worker that dies mid-request
+        cannot hold a slot forever.
+        """
+        now = datetime.utcnow()
+        lease = ObjectId()
+        live = {'$filter': {
+            'input': {'$ifNull': ['$leases', []]},
+            'cond': {'$gt': ['$$this.expires_at', now]}
+        }}
+        pipeline = [
+            {'$set': {'leases': live}},
+            {'$set': {'leases': {'$cond': [
+                {'$lt': [{'$size': '$leases'}, limit]},
+                {'$concatArrays': ['$leases', [{'lease': lease, 'expires_at': now + timedelta(seconds=ttl)}]]},
+                '$leases'
+            ]}}},
+        ]
+        collection = self._collection()
+        try:
+            doc = collection.find_one_and_update(
+                {'_id': key}, pipeline, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            doc = collection.find_one_and_update(
+                {'_id': key}, pipeline, return_document=ReturnDocument.AFTER
+            )
+        if any(entry['lease'] == lease for entry in doc['leases']):
+            return lease
+        return None
+
+    def release_slot(self, key, lease):
+        self._collection().update_one({'_id': key}, {'$pull': {'leases': {'lease': lease}}})
+
+
+class SubmissionLimiter:
+    """Admission control for the public submission endpoints.
+
+    Requests are checked against a per-client-IP and a per-form token bucket,
+    then against a concurrency cap. Anything over a limit is rejected right
+    away with 429 and Retry-After instead of queueing behind busy workers.
+    The cap is either a set of leases in one Mongo document shared by all
+    workers (exact, but two writes to that document per submission) or an
+    in-process counter holding each worker's share of it
+    (SUBMISSION_SLOT_STORAGE).
+
+    The client IP is the socket peer. Behind reverse proxies, set
+    PROXY_FIX_HOPS so it is taken from X-Forwarded-For instead; otherwise
+    all clients share the proxy's bucket.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.store = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.enabled = config.get('RATE_LIMIT_ENABLED', True)
+        self.form_rate = config.get('RATE_LIMIT_FORM_RATE', 20.0)
+        self.form_burst = config.get('RATE_LIMIT_FORM_BURST', 100)
+        self.ip_rate = config.get('RATE_LIMIT_IP_RATE', 1.0)
+        self.ip_burst = config.get('RATE_LIMIT_IP_BURST', 10)
+        self.max_concurrency = config.get('SUBMISSION_MAX_CONCURRENCY', 16)
+        self.slot_ttl = config.get('SUBMISSION_SLOT_TTL_SECONDS', 60)
+
+        if config.get('RATE_LIMIT_STORAGE', 'mongo') == 'memory':
+            self.store = MemoryLimiterStore()
+        else:
+            from models import mongo
+            self.store = MongoLimiterStore(lambda: mongo.db.rate_limits)
+
+        if config.get('SUBMISSION_SLOT_STORAGE', 'mongo') == 'memory':
+            self.slot_store = MemoryLimiterStore()
+            workers = max(1, config.get('GUNICORN_WORKERS', 1))
+            self.max_concurrency = max(1, self.max_concurrency // workers)
+        else:
+            from models import mongo
+            self.slot_store = MongoLimiterStore(lambda: mongo.db.rate_limits)
+
+    def client_ip(self):
+        # ProxyFix (PROXY_FIX_HOPS) has already resolved forwarded addresses
+        return request.remote_addr or 'unknown'
+
+    def check(self, form_id, client_ip):
+        """Return seconds to wait before retrying, or 0 if the request is admitted."""
+        try:
+            wait = self.store.consume(f'ip:{client_ip}', self.ip_rate, self.ip_burst)
+            if wait:
+                return wait
+            return self.store.consume(f'form:{form_id}', self.form_rate, self.form_burst)
+        except PyMongoError as e:
+            # Fail open: a limiter outage must not take submissions down with it
+            logger.error(f"Rate limiter unavailable: {str(e)}")
+            return 0
+
+    def limit(self, view):
+        @wraps(view)
+        def wrapper(form_id, *args, **kwargs):
+            if not self.enabled:
+                return view(form_id, *args, **kwargs)
+
+            wait = self.check(form_id, self.client_ip())
+            if wait:
+                return _too_many_requests('Rate limit exceeded', wait)
+
+            try:
+                lease = self.slot_store.acquire_slot('slots:submissions', self.max_concurrency, self.slot_ttl)
+            except PyMongoError as e:
+                logger.error(f"Rate limiter unavailable: {str(e)}")
+                return view(form_id, *args, **kwargs)
+            if lease is None:
+                return _too_many_requests('Server is busy', 1)
+            try:
+                return view(form_id, *args, **kwargs)
+            finally:
+                try:
+                    self.slot_store.release_slot('slots:submissions', lease)
+                except PyMongoError as e:
+                    # The lease expires on its own after SUBMISSION_SLOT_TTL_SECONDS
+                    logger.error(f"Could not release submission slot: {str(e)}")
+        return wrapper
+
+
+def _too_many_requests(message, retry_after):
+    retry_after = max(1, math.ceil(retry_after))
+    response = jsonify({'error': message, 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+submission_limiter = SubmissionLimiter()
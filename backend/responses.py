@@ -1,7 +1,14 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response as HttpResponse, stream_with_context, current_app
+from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import Response, Form
+from rate_limit import submission_limiter
+from idempotency import idempotency_keys
+from live_feed import response_feed
 from bson.objectid import ObjectId
 from datetime import datetime
+from werkzeug.exceptions import RequestEntityTooLarge
+from concurrent.futures import TimeoutError as SheetsQueueTimeout
+import json
 import logging
 
 responses_bp = Blueprint('responses', __name__)
@@ -23,7 +30,161 @@ def get_responses(form_id):
         logger.error(f"Error fetching responses: {str(e)}")
         return jsonify({'error': 'Failed to fetch responses'}), 500
 
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 200
+
+
+def _parse_datetime(value):
+    if not value:
+        return None
+    return datetime.fromisoformat(value.rstrip('Z'))
+
+
+def _field_filters(form, args):
+    """Build exact-match filters from `field.<id or label>=value` query args"""
+    filters = {}
+    fields = form.get('fields', []) or []
+    for name, values in args.lists():
+        if not name.startswith('field.'):
+            continue
+        key = name[len('field.'):]
+        if not key or key.startswith('$') or '.' in key:
+            raise ValueError(f'Invalid field filter: {name}')
+        # Responses are keyed by field label or by field id, accept either
+        keys = {key}
+        for field in fields:
+            if field and key in (field.get('id'), field.get('label')):
+                keys.update(k for k in (field.get('id'), field.get('label')) if k and '.' not in k)
+        accepted = []
+        for value in values:
+            accepted.append(value)
+            try:
+                accepted.append(int(value) if value.lstrip('-').isdigit() else float(value))
+            except ValueError:
+                pass
+        filters[tuple(sorted(keys))] = accepted
+    return filters
+
+
+@responses_bp.route('/<form_id>/search', methods=['GET'])
+@jwt_required()
+def search_responses(form_id):
+    """Search a form's responses by date range, field values and free text"""
+    form = Form.find_by_id(form_id)
+    if not form:
+        return jsonify({'error': 'Form not found'}), 404
+    if str(form['user_id']) != get_jwt_identity():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    try:
+        start = _parse_datetime(request.args.get('from'))
+        end = _parse_datetime(request.args.get('to'))
+        filters = _field_filters(form, request.args)
+        limit = min(max(int(request.args.get('limit', SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_PAGE_SIZE)
+        after = None
+        if request.args.get('cursor'):
+            timestamp, last_id = request.args['cursor'].split('_', 1)
+            after = (datetime.utcfromtimestamp(int(timestamp) / 1000.0), ObjectId(last_id))
+    except Exception as e:
+        return jsonify({'error': 'Invalid search parameters', 'details': str(e)}), 400
+
+    try:
+        # Fetch one extra row to know whether another page exists
+        responses = Response.search(form_id, start=start, end=end, filters=filters,
+                                    text=request.args.get('q'), after=after, limit=limit + 1)
+    except Exception as e:
+        logger.error(f"Error searching responses: {str(e)}")
+        return jsonify({'error': 'Failed to search responses'}), 500
+
+    next_cursor = None
+    if len(responses) > limit:
+        responses = responses[:limit]
+        last = responses[-1]
+        millis = int((last['submitted_at'] - datetime(1970, 1, 1)).total_seconds() * 1000)
+        next_cursor = f"{millis}_{last['_id']}"
+    for response in responses:
+        response['_id'] = str(response['_id'])
+        response['form_id'] = str(response['form_id'])
+    return jsonify({'responses': responses, 'next_cursor': next_cursor}), 200
+
+
+@responses_bp.route('/<form_id>/live', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])
+def live_responses(form_id):
+    """Push new responses for a form as Server-Sent Events"""
+    form = Form.find_by_id(form_id)
+    if not form:
+        return jsonify({'error': 'Form not found'}), 404
+    if str(form['user_id']) != get_jwt_identity():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    if response_feed.subscriber_count() >= current_app.config.get('LIVE_FEED_MAX_SUBSCRIBERS', 4):
+        response = jsonify({'error': 'Too many live connections, retry later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+
+    # EventSource sends Last-Event-ID on reconnect; allow it as a query arg for manual resumes
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    response = HttpResponse(response_feed.stream(form_id, last_event_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@responses_bp.route('/<form_id>/files/<file_id>', methods=['GET'])
+@jwt_required()
+def download_file(form_id, file_id):
+    """Download a file uploaded with a response (supports Range requests)"""
+    form = Form.find_by_id(form_id)
+    if not form:
+        return jsonify({'error': 'Form not found'}), 404
+    if str(form['user_id']) != get_jwt_identity():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    from file_storage import download_response
+    response = download_response(form_id, file_id)
+    if response is None:
+        return jsonify({'error': 'File not found'}), 404
+    return response
+
+
+@responses_bp.route('/<form_id>/import', methods=['POST'])
+@jwt_required()
+def import_responses(form_id):
+    """Bulk import responses from a CSV upload, streaming NDJSON progress"""
+    form = Form.find_by_id(form_id)
+    if not form:
+        return jsonify({'error': 'Form not found'}), 404
+    if str(form['user_id']) != get_jwt_identity():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    # Raw text/csv bodies are read straight off the socket; multipart uploads use the spooled file
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('file')
+        if not upload:
+            return jsonify({'error': 'CSV file is required'}), 400
+        stream = upload.stream
+    else:
+        stream = request.stream
+
+    from csv_import import import_csv
+    chunk_size = current_app.config.get('IMPORT_CHUNK_SIZE', 1000)
+
+    def generate():
+        try:
+            for event in import_csv(form, stream, chunk_size):
+                yield json.dumps(event) + '\n'
+        except Exception as e:
+            logger.error(f"CSV import failed for form {form_id}: {str(e)}")
+            yield json.dumps({'event': 'error', 'error': str(e)}) + '\n'
+
+    return HttpResponse(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 @responses_bp.route('/<form_id>', methods=['POST'])
+@idempotency_keys.idempotent
+@submission_limiter.limit
 def submit_response(form_id):
     """Submit a new form response and sync with Google Sheets"""
     try:
@@ -33,37 +194,50 @@ def submit_response(form_id):
             logger.warning(f"Form not found: {form_id}")
             return jsonify({'error': 'Form not found'}), 404
         
-        # Validate request data
-        data = request.get_json()
+        # Validate request data; multipart submissions stream file fields into GridFS
+        has_files = request.mimetype == 'multipart/form-data'
+        if has_files:
+            from file_storage import parse_multipart_submission
+            try:
+                data = parse_multipart_submission(
+                    form,
+                    current_app.config.get('UPLOAD_MAX_FILE_BYTES'),
+                    current_app.config.get('UPLOAD_MAX_REQUEST_BYTES'),
+                    current_app.config.get('UPLOAD_MAX_FORM_BYTES')
+                )
+            except RequestEntityTooLarge as e:
+                return jsonify({'error': 'Upload too large', 'details': e.description}), 413
+            except ValueError as e:
+                return jsonify({'error': 'Invalid multipart submission', 'details': str(e)}), 400
+        else:
+            data = request.get_json()
         if not data:
             logger.warning("No response data provided")
             return jsonify({'error': 'Response data is required'}), 400
         
         # Save response to database
-        response_id = Response.create(form_id, data)
+        try:
+            response_id = Response.create(form_id, data)
+        except Exception:
+            if has_files:
+                from file_storage import delete_files
+                delete_files(data)
+            raise
         logger.info(f"Response saved to database: {response_id.inserted_id}")
 
+        # Webhooks are delivered by the job workers, batched per endpoint
+        try:
+            from webhooks import schedule_webhooks
+            schedule_webhooks(form, response_id.inserted_id)
+        except Exception as e:
+            logger.error(f"Could not queue webhooks for form {form_id}: {str(e)}")
+
         # Google Sheets integration - use per-form sheet/tab name
-        # Get spreadsheet_id from form settings or top-level
-        spreadsheet_id = None
-        if 'settings' in form and 'google_sheet_id' in form['settings'] and form['settings']['google_sheet_id']:
-            spreadsheet_id = form['settings']['google_sheet_id']
-        elif 'google_sheet_id' in form and form['google_sheet_id']:
-            spreadsheet_id = form['google_sheet_id']
-
-        # Always use the top-level google_sheet_name if present, fallback to settings, fallback to SheetN logic
-        sheet_name = None
-        if 'google_sheet_name' in form and form['google_sheet_name']:
-            sheet_name = form['google_sheet_name']
-        elif 'settings' in form and 'google_sheet_name' in form['settings'] and form['settings']['google_sheet_name']:
-            sheet_name = form['settings']['google_sheet_name']
-        else:
-            # Fallback: assign SheetN based on form id hash (to avoid all going to Sheet1)
-            import hashlib
-            n = int(hashlib.sha256(str(form_id).encode()).hexdigest(), 16) % 1000 + 1
-            sheet_name = f"Sheet{n}"
+        from sheet_jobs import sheet_target, sheet_row, is_provisioned, stored_columns, schedule_sheet_provisioning
+        spreadsheet_id, sheet_name = sheet_target(form)
         sheets_error = None
         sheets_result = None
+        sheets_queued = False
         sync_attempted = False
 
         # Only proceed if we have a spreadsheet ID
@@ -71,43 +245,45 @@ def submit_response(form_id):
             sync_attempted = True
             try:
                 from google_sheets import sheets_service
+                from sheets_scheduler import sheets_scheduler
 
-                # Safely get fields (handle None case)
                 fields = form.get('fields', []) or []
 
-
-                # Prepare headers and data
-                headers = []
-                row_data = []
-
-                # Fallback: if data does not contain field labels, map field IDs to labels
-                data_keys = set(data.keys())
-                label_keys = set(field['label'] for field in fields if field and 'label' in field)
-                id_keys = set(field['id'] for field in fields if field and 'id' in field)
-                use_id_keys = len(data_keys & id_keys) > len(data_keys & label_keys)
-
-                for field in fields:
-                    if field and 'label' in field:
-                        headers.append(field['label'])
-                        if use_id_keys and 'id' in field:
-                            row_data.append(str(data.get(field['id'], '')))
-                        else:
-                            row_data.append(str(data.get(field['label'], '')))
+                # Rows follow the tab's last known layout (field order before the
+                # first provisioning). Column changes are left to the provisioning
+                # job, the only writer allowed to move columns.
+                columns = stored_columns(form, spreadsheet_id, sheet_name)
+                if not is_provisioned(form, spreadsheet_id, sheet_name):
+                    schedule_sheet_provisioning(form['_id'])
+                headers, row_data = sheet_row(fields, data, columns)
 
                 logger.info(f"Google Sheets headers: {headers}")
                 logger.info(f"Google Sheets row_data: {row_data}")
 
-                # Ensure sheet exists and has headers
-                try:
-                    sheets_service.ensure_sheet_exists(spreadsheet_id, sheet_name)
-                    sheets_service.write_headers(spreadsheet_id, sheet_name, headers)
-                except Exception as header_error:
-                    logger.warning(f"Header setup issue: {str(header_error)}")
-
-                # Append the data
-                sheets_result = sheets_service.append_data(spreadsheet_id, sheet_name, row_data)
+                # Append the data; all Sheets calls for this request share one time budget
+                with sheets_scheduler.deadline(current_app.config.get('SHEETS_SUBMIT_BUDGET_SECONDS', 10)):
+                    try:
+                        sheets_result = sheets_service.append_data(spreadsheet_id, sheet_name, row_data)
+                    except SheetsQueueTimeout:
+                        raise
+                    except Exception:
+                        if form.get('sheet_rename_from'):
+                            # The rename job may have renamed the tab already; never recreate the old name
+                            sheets_result = sheets_service.append_data(spreadsheet_id, form['google_sheet_name'], row_data)
+                        else:
+                            # No such tab (not provisioned yet, or deleted by hand): create it and retry once
+                            if not sheets_service.ensure_tab(spreadsheet_id, sheet_name, headers):
+                                raise
+                            logger.warning(f"Created missing tab '{sheet_name}' for form {form_id}")
+                            sheets_result = sheets_service.append_data(spreadsheet_id, sheet_name, row_data)
                 logger.info(f"Data appended to Google Sheets: {sheets_result}")
 
+            except SheetsQueueTimeout:
+                # The timed-out append was withdrawn unsent; a background job appends the row
+                from sheet_jobs import schedule_response_append
+                schedule_response_append(form['_id'], response_id.inserted_id)
+                sheets_queued = True
+                logger.warning(f"Google Sheets append for form {form_id} moved to the job queue")
             except Exception as e:
                 sheets_error = str(e)
                 logger.error(f"Google Sheets error: {sheets_error}")
@@ -123,6 +299,7 @@ def submit_response(form_id):
                 'sheet_name': sheet_name,
                 'sync_attempted': sync_attempted,
                 'success': sheets_result is not None,
+                'queued': sheets_queued,
                 'error': sheets_error,
                 'updated_range': sheets_result.get('updates', {}).get('updatedRange') if sheets_result else None
             }
@@ -0,0 +1,256 @@
+import hashlib
+import json
+import logging
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from flask import current_app
+
+from jobs import job_queue, LeaseLost
+from models import Form, mongo
+
+logger = logging.getLogger(__name__)
+
+RENAME_SHEET_TAB = 'rename_sheet_tab'
+PROVISION_SHEET = 'provision_sheet'
+APPEND_IMPORT = 'append_import_to_sheet'
+APPEND_RESPONSE = 'append_response_to_sheet'
+
+
+def sheet_target(form):
+    """Return (spreadsheet_id, tab name) a form's responses are written to."""
+    # Get spreadsheet_id from form settings or top-level
+    spreadsheet_id = None
+    if 'settings' in form and 'google_sheet_id' in form['settings'] and form['settings']['google_sheet_id']:
+        spreadsheet_id = form['settings']['google_sheet_id']
+    elif 'google_sheet_id' in form and form['google_sheet_id']:
+        spreadsheet_id = form['google_sheet_id']
+
+    # Always use the top-level google_sheet_name if present, fallback to settings, fallback to SheetN logic
+    if form.get('sheet_rename_from'):
+        # A title change is still being applied; the tab keeps its old name until then
+        sheet_name = form['sheet_rename_from']
+    elif 'google_sheet_name' in form and form['google_sheet_name']:
+        sheet_name = form['google_sheet_name']
+    elif 'settings' in form and 'google_sheet_name' in form['settings'] and form['settings']['google_sheet_name']:
+        sheet_name = form['settings']['google_sheet_name']
+    else:
+        # Fallback: assign SheetN based on form id hash (to avoid all going to Sheet1)
+        n = int(hashlib.sha256(str(form['_id']).encode()).hexdigest(), 16) % 1000 + 1
+        sheet_name = f"Sheet{n}"
+    return spreadsheet_id, sheet_name
+
+
+def column_key(field):
+    # Field ids survive label edits; template-based forms only have labels
+    return field.get('id') or field['label']
+
+
+def sheet_columns(fields):
+    """(key, label) for each field that gets a sheet column, in field order."""
+    columns = []
+    seen = set()
+    for field in fields:
+        if field and 'label' in field and column_key(field) not in seen:
+            seen.add(column_key(field))
+            columns.append((column_key(field), field['label']))
+    return columns
+
+
+def sheet_row(fields, data, columns=None):
+    """Return (headers, row) for one response.
+
+    Cells follow `columns`, the tab's stored column map, when given and
+    field order otherwise; columns of removed fields are left empty.
+    """
+    # Fallback: if data does not contain field labels, map field IDs to labels
+    data_keys = set(data.keys())
+    label_keys = set(field['label'] for field in fields if field and 'label' in field)
+    id_keys = set(field['id'] for field in fields if field and 'id' in field)
+    use_id_keys = len(data_keys & id_keys) > len(data_keys & label_keys)
+
+    cells = {}
+    for field in fields:
+        if field and 'label' in field:
+            if use_id_keys and 'id' in field:
+                value = data.get(field['id'], '')
+            else:
+                value = data.get(field['label'], '')
+            cells.setdefault(column_key(field), _cell(value))
+
+    if columns is None:
+        columns = [{'key': key, 'label': label} for key, label in sheet_columns(fields)]
+    return [c['label'] for c in columns], [cells.get(c['key'], '') for c in columns]
+
+
+def _cell(value):
+    # Uploaded files are stored in GridFS; the sheet shows the file name
+    if isinstance(value, dict) and 'file_id' in value:
+        return value.get('filename') or value['file_id']
+    return str(value)
+
+
+def fields_hash(fields):
+    """Fingerprint of the columns a form's fields produce."""
+    return hashlib.sha1(json.dumps(sheet_columns(fields or [])).encode()).hexdigest()
+
+
+def stored_columns(form, spreadsheet_id, sheet_name):
+    """The column map recorded for the form's tab, or None if it is for another tab."""
+    mapping = form.get('sheet_columns') or {}
+    if mapping.get('spreadsheet_id') == spreadsheet_id and mapping.get('sheet_name') == sheet_name:
+        return mapping.get('columns')
+    return None
+
+
+def is_provisioned(form, spreadsheet_id, sheet_name):
+    """True when the tab and header row for the form's current fields are known to exist."""
+    provisioning = form.get('sheet_provisioning') or {}
+    return (provisioning.get('state') == 'ready'
+            and provisioning.get('spreadsheet_id') == spreadsheet_id
+            and provisioning.get('sheet_name') == sheet_name
+            and provisioning.get('fields_hash') == fields_hash(form.get('fields'))
+            and stored_columns(form, spreadsheet_id, sheet_name) is not None)
+
+
+def sync_sheet(form, spreadsheet_id, sheet_name, heartbeat=None):
+    """Create the form's tab if needed, align its columns with the fields and store the column map.
+
+    Only the provisioning job calls this: its job key keeps syncs of one form
+    from overlapping, which the column moves require.
+    """
+    from google_sheets import sheets_service
+    columns = sheets_service.sync_headers(
+        spreadsheet_id, sheet_name,
+        sheet_columns(form.get('fields', []) or []),
+        stored_columns(form, spreadsheet_id, sheet_name),
+        heartbeat
+    )
+    form['sheet_columns'] = {'spreadsheet_id': spreadsheet_id, 'sheet_name': sheet_name, 'columns': columns}
+    Form.set_sheet_columns(form['_id'], form['sheet_columns'])
+    return columns
+
+
+def schedule_sheet_provisioning(form_id):
+    return job_queue.enqueue(
+        PROVISION_SHEET,
+        {'form_id': str(form_id)},
+        key=f'{PROVISION_SHEET}:{form_id}'
+    )
+
+
+@job_queue.handler(PROVISION_SHEET)
+def provision_sheet(job):
+    """Create a form's tab and write its header row ahead of the first submission."""
+    form = Form.find_by_id(job['payload']['form_id'])
+    if not form or form.get('sheet_rename_from'):
+        # A pending rename queues provisioning again once the tab has its new name
+        return
+    spreadsheet_id, sheet_name = sheet_target(form)
+    if not spreadsheet_id or is_provisioned(form, spreadsheet_id, sheet_name):
+        return
+    fields = form.get('fields', []) or []
+    state = {
+        'spreadsheet_id': spreadsheet_id,
+        'sheet_name': sheet_name,
+        'fields_hash': fields_hash(fields),
+    }
+
+    try:
+        sync_sheet(form, spreadsheet_id, sheet_name, lambda: job_queue.heartbeat(job))
+    except LeaseLost:
+        raise
+    except Exception as e:
+        Form.set_sheet_provisioning(form['_id'], dict(state, state='failed', error=str(e)))
+        raise
+    Form.set_sheet_provisioning(form['_id'], dict(state, state='ready', provisioned_at=datetime.utcnow()))
+
+
+def schedule_sheet_rename(form_id):
+    return job_queue.enqueue(
+        RENAME_SHEET_TAB,
+        {'form_id': str(form_id)},
+        key=f'{RENAME_SHEET_TAB}:{form_id}'
+    )
+
+
+@job_queue.handler(RENAME_SHEET_TAB)
+def rename_sheet_tab(job):
+    """Apply a pending tab rename recorded by Form.update_owned."""
+    form = Form.find_by_id(job['payload']['form_id'])
+    if not form or not form.get('sheet_rename_from'):
+        return
+    old_name = form['sheet_rename_from']
+    new_name = form['google_sheet_name']
+    spreadsheet_id = sheet_target(form)[0]
+    if not spreadsheet_id:
+        # No sheet configured: there is no tab, only the recorded name to update
+        Form.finish_sheet_rename(form['_id'], old_name, new_name)
+        return
+
+    from google_sheets import sheets_service
+    if not sheets_service.rename_sheet(spreadsheet_id, old_name, new_name):
+        # No tab yet; provisioning below creates it under the new name
+        logger.info(f"No tab '{old_name}' to rename for form {form['_id']}")
+    Form.finish_sheet_rename(form['_id'], old_name, new_name)
+    schedule_sheet_provisioning(form['_id'])
+
+
+def schedule_import_append(form_id, import_id):
+    return job_queue.enqueue(APPEND_IMPORT, {'form_id': str(form_id), 'import_id': str(import_id)})
+
+
+def schedule_response_append(form_id, response_id):
+    return job_queue.enqueue(APPEND_RESPONSE, {'form_id': str(form_id), 'response_id': str(response_id)})
+
+
+@job_queue.handler(APPEND_IMPORT)
+def append_import_to_sheet(job):
+    """Append the responses of one CSV import to the form's sheet in large batches."""
+    _append_to_sheet(job, {'import_id': ObjectId(job['payload']['import_id'])})
+
+
+@job_queue.handler(APPEND_RESPONSE)
+def append_response_to_sheet(job):
+    """Append a submission whose inline append ran out of time."""
+    _append_to_sheet(job, {'_id': ObjectId(job['payload']['response_id'])})
+
+
+def _append_to_sheet(job, query):
+    """Append the responses matching `query` in _id order, recording progress per batch.
+
+    A batch that was never sent (withdrawn on timeout, or rejected with 429)
+    is appended again by the job retry. An append whose reply was lost
+    (socket timeout, 5xx) may have landed; Sheets has no dedupe key, so the
+    retry can repeat that one batch.
+    """
+    form = Form.find_by_id(job['payload']['form_id'])
+    if not form:
+        return
+    spreadsheet_id, sheet_name = sheet_target(form)
+    if not spreadsheet_id:
+        return
+    if form.get('sheet_rename_from'):
+        # The tab may already carry either name; fail and let the job retry after the rename
+        raise RuntimeError(f"Tab rename pending for form {form['_id']}")
+    fields = form.get('fields', []) or []
+    batch_size = current_app.config.get('IMPORT_SHEETS_BATCH_SIZE', 500)
+
+    from google_sheets import sheets_service
+    # Rows follow the tab's last known layout; column changes are the provisioning job's
+    columns = stored_columns(form, spreadsheet_id, sheet_name)
+    if not is_provisioned(form, spreadsheet_id, sheet_name):
+        schedule_sheet_provisioning(form['_id'])
+        sheets_service.ensure_tab(spreadsheet_id, sheet_name, sheet_row(fields, {}, columns)[0])
+
+    appended = job['progress'].get('appended', 0)
+    last_id = job['progress'].get('last_id')
+    while True:
+        batch_query = {'$and': [query, {'_id': {'$gt': ObjectId(last_id)}}]} if last_id else query
+        batch = list(mongo.db.responses.find(batch_query, {'data': 1}).sort('_id', 1).limit(batch_size))
+        if not batch:
+            break
+        sheets_service.append_rows(spreadsheet_id, sheet_name, [sheet_row(fields, r['data'], columns)[1] for r in batch])
+        appended += len(batch)
+        last_id = str(batch[-1]['_id'])
+        job_queue.heartbeat(job, appended=appended, last_id=last_id)
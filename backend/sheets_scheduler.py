@@ -0,0 +1,245 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+
+from googleapiclient.errors import HttpError
+
+logger = logging.getLogger(__name__)
+
+# Lower value runs first: losing an append loses a row, a late metadata read only costs latency
+PRIORITY_APPEND = 0
+PRIORITY_WRITE = 1
+PRIORITY_READ = 2
+
+PRIORITY_NAMES = {PRIORITY_APPEND: 'append', PRIORITY_WRITE: 'write', PRIORITY_READ: 'read'}
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# An append that timed out or got a 5xx may still have been applied, and
+# appends carry no dedupe key; only a 429 guarantees it was not
+RETRYABLE_APPEND_STATUSES = (429,)
+
+
+class _Bucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Task:
+    def __init__(self, fn, spreadsheet_id, priority):
+        self.fn = fn
+        self.spreadsheet_id = spreadsheet_id
+        self.priority = priority
+        self.attempts = 0
+        self.not_before = 0
+        self.future = Future()
+
+
+class SheetsScheduler:
+    """Single gate in front of every Google Sheets API call made by this worker.
+
+    Calls are queued by priority and dispatched only when both the project
+    bucket and the target spreadsheet's bucket have a token, keeping us under
+    Google's write quotas. The buckets live in this process, so each of the
+    GUNICORN_WORKERS processes gets an equal share of the configured rates.
+    Calls rejected with 429/5xx are retried with jittered exponential backoff
+    instead of being dropped; appends only on 429, so no row is written twice.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._buckets = {}
+        self._started = False
+        self._in_flight = 0
+        self._local = threading.local()
+
+    def start(self, config):
+        with self._cond:
+            if self._started:
+                return
+            # The quotas are per project, shared by every worker process
+            workers = max(1, config.get('GUNICORN_WORKERS', 1))
+            self.project_rate = config.get('SHEETS_PROJECT_RATE', 5.0) / workers
+            self.project_burst = max(1, config.get('SHEETS_PROJECT_BURST', 10) // workers)
+            self.sheet_rate = config.get('SHEETS_SPREADSHEET_RATE', 1.0) / workers
+            self.sheet_burst = max(1, config.get('SHEETS_SPREADSHEET_BURST', 5) // workers)
+            self.max_retries = config.get('SHEETS_MAX_RETRIES', 6)
+            self.base_delay = config.get('SHEETS_BACKOFF_BASE', 1.0)
+            self.max_delay = config.get('SHEETS_BACKOFF_MAX', 64.0)
+            self.timeout = config.get('SHEETS_REQUEST_TIMEOUT', 30.0)
+            self._project = _Bucket(self.project_rate, self.project_burst)
+            for i in range(config.get('SHEETS_WORKER_THREADS', 4)):
+                threading.Thread(target=self._work, name=f'sheets-{i}', daemon=True).start()
+            self._started = True
+
+    def submit(self, fn, spreadsheet_id, priority=PRIORITY_WRITE):
+        """Queue `fn` and return a Future for its result."""
+        task = _Task(fn, spreadsheet_id, priority)
+        self._push(task)
+        return task.future
+
+    @contextmanager
+    def deadline(self, seconds):
+        """Cap the total time the calls made in this block wait, not just each call."""
+        previous = getattr(self._local, 'deadline', None)
+        self._local.deadline = time.monotonic() + seconds
+        try:
+            yield
+        finally:
+            self._local.deadline = previous
+
+    def run(self, fn, spreadsheet_id, priority=PRIORITY_WRITE):
+        """Queue `fn` and wait for its result.
+
+        Waits up to SHEETS_REQUEST_TIMEOUT, or less inside deadline(). A call
+        that has not been sent by then is withdrawn and TimeoutError raised,
+        so a caller that retries never gets the call carried out twice. A
+        call that is being sent at that moment is waited for.
+        """
+        timeout = self.timeout
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                raise FutureTimeout()
+        task = _Task(fn, spreadsheet_id, priority)
+        self._push(task)
+        while True:
+            try:
+                return task.future.result(timeout=timeout)
+            except FutureTimeout:
+                if self._withdraw(task):
+                    raise
+                # In flight; it either finishes or comes back to the queue for a retry
+                timeout = 1.0
+
+    def _withdraw(self, task):
+        """Take a task back out of the queue; False if a worker is running it."""
+        with self._cond:
+            for entry in self._heap:
+                if entry[2] is task:
+                    self._heap.remove(entry)
+                    heapq.heapify(self._heap)
+                    break
+            else:
+                return False
+        if not task.future.cancel():
+            # Waiting for a retry: the future already counts as running
+            task.future.set_exception(FutureTimeout())
+        return True
+
+    def stats(self):
+        with self._cond:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            retrying = 0
+            for _, _, task in self._heap:
+                depth[PRIORITY_NAMES[task.priority]] += 1
+                if task.attempts:
+                    retrying += 1
+            return {
+                'queued': len(self._heap),
+                'by_priority': depth,
+                'retrying': retrying,
+                'in_flight': self._in_flight,
+            }
+
+    def _push(self, task):
+        with self._cond:
+            heapq.heappush(self._heap, (task.priority, next(self._seq), task))
+            self._cond.notify()
+
+    def _sheet_bucket(self, spreadsheet_id):
+        bucket = self._buckets.get(spreadsheet_id)
+        if bucket is None:
+            bucket = self._buckets[spreadsheet_id] = _Bucket(self.sheet_rate, self.sheet_burst)
+        return bucket
+
+    def _next_task(self):
+        """Pop the highest-priority task that may run now, else return how long to wait."""
+        now = time.monotonic()
+        wait = self._project.wait_time(now)
+        if wait:
+            return None, wait
+        wait = None
+        for entry in sorted(self._heap):
+            task = entry[2]
+            if task.not_before > now:
+                delay = task.not_before - now
+            else:
+                delay = self._sheet_bucket(task.spreadsheet_id).wait_time(now)
+            if not delay:
+                self._heap.remove(entry)
+                heapq.heapify(self._heap)
+                self._project.take()
+                self._sheet_bucket(task.spreadsheet_id).take()
+                return task, None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = None
+                while task is None:
+                    task, wait = self._next_task() if self._heap else (None, None)
+                    if task is None:
+                        self._cond.wait(wait)
+                self._in_flight += 1
+            try:
+                self._execute(task)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+
+    def _execute(self, task):
+        # Retries reuse the Future, which is already running after the first attempt
+        if task.attempts == 0 and not task.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = task.fn()
+        except Exception as e:
+            delay = self._retry_delay(task, e)
+            if delay is None:
+                task.future.set_exception(e)
+                return
+            logger.warning(f"Sheets call for {task.spreadsheet_id} failed ({str(e)}), "
+                           f"retry {task.attempts} in {delay:.1f}s")
+            task.not_before = time.monotonic() + delay
+            self._push(task)
+        else:
+            task.future.set_result(result)
+
+    def _retry_delay(self, task, error):
+        retryable = RETRYABLE_APPEND_STATUSES if task.priority == PRIORITY_APPEND else RETRYABLE_STATUSES
+        if isinstance(error, HttpError):
+            if error.resp.status not in retryable:
+                return None
+        elif task.priority == PRIORITY_APPEND or not isinstance(error, OSError):
+            return None
+        task.attempts += 1
+        if task.attempts > self.max_retries:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** task.attempts))
+        if isinstance(error, HttpError) and error.resp.get('retry-after', '').isdigit():
+            delay = max(delay, float(error.resp['retry-after']))
+        return delay
+
+
+sheets_scheduler = SheetsScheduler()
@@ -0,0 +1,337 @@
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import secrets
+import socket
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+import requests
+from bson.objectid import ObjectId
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from jobs import job_queue
+from models import Form, mongo
+
+logger = logging.getLogger(__name__)
+
+DELIVER_WEBHOOKS = 'deliver_webhooks'
+SIGNATURE_HEADER = 'X-Webhook-Signature'
+TIMESTAMP_HEADER = 'X-Webhook-Timestamp'
+
+
+class WebhookError(Exception):
+    pass
+
+
+class BlockedTarget(WebhookError):
+    pass
+
+
+def _non_public(address):
+    address = ipaddress.ip_address(address.split('%')[0])
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return not address.is_global or address.is_multicast
+
+
+def blocked_host(host):
+    """Return why `host` may not receive webhooks, judged without a DNS lookup.
+
+    Catches IP literals outside the public internet and names that only make
+    sense on an internal network (localhost, single-label service names such
+    as `mongodb`). Names that resolve to internal addresses are caught when
+    connecting, by the pinned connections below.
+    """
+    if current_app.config.get('WEBHOOK_ALLOW_PRIVATE_TARGETS', False):
+        return None
+    host = (host or '').rstrip('.').lower()
+    if not host:
+        return 'no host'
+    try:
+        if _non_public(host):
+            return f'{host} is not a public address'
+        return None
+    except ValueError:
+        pass
+    if host == 'localhost' or host.endswith('.localhost') or '.' not in host:
+        return f'{host} is an internal name'
+    return None
+
+
+def public_address(host, port):
+    """Resolve `host` and return an address to connect to; BlockedTarget if any is non-public."""
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    if not current_app.config.get('WEBHOOK_ALLOW_PRIVATE_TARGETS', False):
+        for info in infos:
+            if _non_public(info[4][0]):
+                raise BlockedTarget(f'{host} resolves to a non-public address ({info[4][0]})')
+    return infos[0][4][0]
+
+
+class _PinnedConnectionMixin:
+    # Resolve and check in the same step as connecting, so a second DNS answer
+    # (rebinding) cannot send us elsewhere. urllib3 dials _dns_host and derives
+    # self.host from it, so the address is swapped in for the dial only: the
+    # Host header, SNI and certificate check stay on the name.
+    def _new_conn(self):
+        name = self._dns_host
+        self._dns_host = public_address(self.host, self.port)
+        try:
+            return super()._new_conn()
+        finally:
+            self._dns_host = name
+
+
+class _PinnedHTTPConnection(_PinnedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _PinnedHTTPSConnection(_PinnedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _PinnedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _PinnedHTTPConnection
+
+
+class _PinnedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _PinnedHTTPSConnection
+
+
+class PinnedAdapter(HTTPAdapter):
+    """HTTPAdapter that only opens connections to public addresses."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _PinnedHTTPConnectionPool,
+            'https': _PinnedHTTPSConnectionPool,
+        }
+
+
+def clean_webhooks(settings):
+    """Validate `settings.webhooks` in place, giving new subscriptions a signing secret.
+
+    Each entry is {'url', 'secret', 'enabled'}. Raises ValueError for bad input.
+    """
+    hooks = (settings or {}).get('webhooks')
+    if hooks is None:
+        return
+    if not isinstance(hooks, list):
+        raise ValueError('settings.webhooks must be a list')
+    cleaned = []
+    for hook in hooks:
+        if not isinstance(hook, dict) or not isinstance(hook.get('url'), str):
+            raise ValueError('each webhook needs a url')
+        url = urlparse(hook['url'].strip())
+        if url.scheme not in ('http', 'https') or not url.netloc:
+            raise ValueError(f"invalid webhook url: {hook['url']}")
+        blocked = blocked_host(url.hostname)
+        if blocked:
+            raise ValueError(f"webhook url not allowed: {blocked}")
+        cleaned.append({
+            'url': url.geturl(),
+            'secret': hook.get('secret') or secrets.token_hex(32),
+            'enabled': bool(hook.get('enabled', True)),
+        })
+    settings['webhooks'] = cleaned
+
+
+def webhook_targets(form):
+    return [h for h in (form.get('settings') or {}).get('webhooks') or []
+            if h.get('enabled', True) and h.get('url')]
+
+
+def sign(secret, timestamp, body):
+    """HMAC-SHA256 over '<timestamp>.<body>', so a captured delivery cannot be replayed later."""
+    message = f'{timestamp}.'.encode() + body
+    return 'sha256=' + hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def _job_key(form_id, url):
+    return f"{DELIVER_WEBHOOKS}:{form_id}:{hashlib.sha1(url.encode()).hexdigest()[:16]}"
+
+
+def schedule_webhooks(form, response_id):
+    """Queue delivery of a new response to each of the form's webhooks.
+
+    Deliveries wait a short batching window, so responses arriving close
+    together go out in one request per endpoint.
+    """
+    hooks = webhook_targets(form)
+    if not hooks:
+        return
+    now = datetime.utcnow()
+    mongo.db.webhook_deliveries.insert_many([{
+        'form_id': form['_id'],
+        'url': hook['url'],
+        'response_id': response_id,
+        'status': 'pending',
+        'attempts': 0,
+        'created_at': now,
+    } for hook in hooks])
+    delay = current_app.config.get('WEBHOOK_BATCH_DELAY_SECONDS', 2)
+    for hook in hooks:
+        job_queue.enqueue(
+            DELIVER_WEBHOOKS,
+            {'form_id': str(form['_id']), 'url': hook['url']},
+            key=_job_key(form['_id'], hook['url']),
+            delay=delay
+        )
+
+
+class WebhookClient:
+    """Keep-alive HTTP client shared by the job workers.
+
+    Sessions are per thread, but they all mount one adapter, so connections
+    to an endpoint are pooled across workers and capped at WEBHOOK_POOL_SIZE.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._adapter = None
+        self._lock = threading.Lock()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            with self._lock:
+                if self._adapter is None:
+                    size = current_app.config.get('WEBHOOK_POOL_SIZE', 10)
+                    self._adapter = PinnedAdapter(pool_connections=size, pool_maxsize=size,
+                                                pool_block=True, max_retries=0)
+            session = self._local.session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            session.headers['User-Agent'] = 'form-builder-webhooks'
+        return session
+
+    def send(self, hook, body, delivery_id):
+        # Checked again per delivery: the hook may predate the check, and the
+        # connection itself refuses non-public addresses (BlockedTarget)
+        blocked = blocked_host(urlparse(hook['url']).hostname)
+        if blocked:
+            raise BlockedTarget(blocked)
+        timestamp = str(int(time.time()))
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Webhook-Id': delivery_id,
+            TIMESTAMP_HEADER: timestamp,
+        }
+        if hook.get('secret'):
+            headers[SIGNATURE_HEADER] = sign(hook['secret'], timestamp, body)
+        # No redirects: a public endpoint could otherwise bounce the POST to an internal one
+        response = self._session().post(
+            hook['url'], data=body, headers=headers, allow_redirects=False,
+            timeout=current_app.config.get('WEBHOOK_TIMEOUT_SECONDS', 10)
+        )
+        if not 200 <= response.status_code < 300:
+            raise WebhookError(f"{hook['url']} answered {response.status_code}")
+
+
+webhook_client = WebhookClient()
+
+
+@job_queue.handler(DELIVER_WEBHOOKS)
+def deliver_webhooks(job):
+    """Send a form's pending deliveries for one endpoint, oldest first, in batches.
+
+    A failed request raises, leaving the batch pending; the job queue retries
+    it with backoff. Delivered entries expire after WEBHOOK_RETENTION_DAYS.
+    """
+    form_id = ObjectId(job['payload']['form_id'])
+    url = job['payload']['url']
+    pending_query = {'form_id': form_id, 'url': url, 'status': 'pending'}
+
+    form = Form.find_by_id(form_id)
+    hook = next((h for h in webhook_targets(form) if h['url'] == url), None) if form else None
+    if hook is None:
+        # Subscription removed or disabled, or the form deleted: nothing to deliver to
+        mongo.db.webhook_deliveries.delete_many(pending_query)
+        return
+
+    batch_size = current_app.config.get('WEBHOOK_BATCH_SIZE', 50)
+    retention = timedelta(days=current_app.config.get('WEBHOOK_RETENTION_DAYS', 7))
+    delivered = job['progress'].get('delivered', 0)
+    while True:
+        batch = list(mongo.db.webhook_deliveries.find(pending_query).sort('_id', 1).limit(batch_size))
+        if not batch:
+            return
+        ids = [d['_id'] for d in batch]
+        responses = mongo.db.responses.find({'_id': {'$in': [d['response_id'] for d in batch]}})
+        body = json.dumps({
+            'event': 'responses.created',
+            'form_id': str(form_id),
+            'responses': [{
+                'id': str(r['_id']),
+                'submitted_at': r['submitted_at'].isoformat() + 'Z',
+                'data': r.get('data', {}),
+            } for r in sorted(responses, key=lambda r: r['_id'])],
+        }, default=str).encode()
+
+        try:
+            webhook_client.send(hook, body, str(ids[0]))
+        except BlockedTarget as e:
+            # Retrying will not help; drop what is pending rather than keep the job failing
+            logger.warning(f"Webhook for form {form_id} blocked: {str(e)}")
+            now = datetime.utcnow()
+            mongo.db.webhook_deliveries.update_many(
+                pending_query,
+                {'$set': {'status': 'blocked', 'last_error': str(e), 'expire_at': now + retention}}
+            )
+            return
+        except (requests.RequestException, WebhookError) as e:
+            mongo.db.webhook_deliveries.update_many(
+                {'_id': {'$in': ids}},
+                {'$inc': {'attempts': 1}, '$set': {'last_error': str(e)}}
+            )
+            raise
+
+        now = datetime.utcnow()
+        mongo.db.webhook_deliveries.update_many(
+            {'_id': {'$in': ids}},
+            {'$set': {'status': 'delivered', 'delivered_at': now, 'expire_at': now + retention}}
+        )
+        delivered += len(batch)
+        job_queue.heartbeat(job, delivered=delivered)
+
+
+if __name__ == '__main__':
+    # Local stand-in for a subscriber: prints deliveries and checks their signature
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 9000
+    secret = sys.argv[2] if len(sys.argv) > 2 else None
+
+    class Receiver(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            verified = None
+            if secret:
+                expected = sign(secret, self.headers.get(TIMESTAMP_HEADER, ''), body)
+                verified = hmac.compare_digest(expected, self.headers.get(SIGNATURE_HEADER, ''))
+            payload = json.loads(body)
+            print(json.dumps({
+                'id': self.headers.get('X-Webhook-Id'),
+                'verified': verified,
+                'responses': len(payload.get('responses', [])),
+                'payload': payload,
+            }), flush=True)
+            self.send_response(204 if verified is not False else 401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    # The app only delivers here with WEBHOOK_ALLOW_PRIVATE_TARGETS=true
+    print(f'Listening for webhooks on http://localhost:{port}/')
+    ThreadingHTTPServer(('', port), Receiver).serve_forever()
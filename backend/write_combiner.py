@@ -0,0 +1,120 @@
+import threading
+import time
+
+from bson import encode
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError, WriteConcernError
+from pymongo.results import InsertOneResult
+from pymongo.write_concern import WriteConcern
+
+
+class _PendingInsert:
+    __slots__ = ('doc', 'done', 'error')
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.done = threading.Event()
+        self.error = None
+
+
+class InsertCombiner:
+    """Group commit for single-document inserts from concurrent requests.
+
+    The first insert to arrive waits up to `window` seconds (or until the
+    batch is full) while other threads add theirs, then writes the whole
+    batch with one unordered insert_many and one write-concern round trip.
+    Every caller still gets its own _id or its own error: documents are
+    key-checked before they join a batch, and a batch that fails as a whole
+    is retried one document at a time. A window of 0 turns this into a plain
+    insert_one.
+    """
+
+    def __init__(self, get_collection):
+        self._get_collection = get_collection
+        self._cond = threading.Condition()
+        self._batch = []
+        self.window = 0
+        self.max_batch = 100
+        self.write_concern = None
+
+    def init_app(self, app):
+        self.window = app.config.get('RESPONSE_INSERT_WINDOW_MS', 0) / 1000.0
+        self.max_batch = app.config.get('RESPONSE_INSERT_MAX_BATCH', 100)
+        w = app.config.get('RESPONSE_WRITE_CONCERN_W')
+        if w is not None or app.config.get('RESPONSE_WRITE_CONCERN_J'):
+            self.write_concern = WriteConcern(
+                w=int(w) if isinstance(w, str) and w.isdigit() else w,
+                j=app.config.get('RESPONSE_WRITE_CONCERN_J') or None
+            )
+
+    def _collection(self):
+        collection = self._get_collection()
+        if self.write_concern is not None:
+            collection = collection.with_options(write_concern=self.write_concern)
+        return collection
+
+    def insert_one(self, doc):
+        doc.setdefault('_id', ObjectId())
+        if self.window <= 0:
+            return self._collection().insert_one(doc)
+
+        # Reject dotted/$ keys here; in the batch they would fail everyone's insert
+        encode(doc, check_keys=True, codec_options=self._get_collection().codec_options)
+
+        pending = _PendingInsert(doc)
+        with self._cond:
+            batch = self._batch
+            batch.append(pending)
+            leader = len(batch) == 1
+            if leader:
+                deadline = time.monotonic() + self.window
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                self._batch = []
+            elif len(batch) >= self.max_batch:
+                self._cond.notify_all()
+
+        if leader:
+            self._flush(batch)
+        else:
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return InsertOneResult(doc['_id'], self.write_concern is None or self.write_concern.acknowledged)
+
+    def _flush(self, batch):
+        try:
+            self._collection().insert_many([p.doc for p in batch], ordered=False)
+        except BulkWriteError as e:
+            for err in e.details.get('writeErrors', []):
+                batch[err['index']].error = WriteError(err.get('errmsg'), err.get('code'), err)
+            concern_errors = e.details.get('writeConcernErrors', [])
+            if concern_errors:
+                error = WriteConcernError(concern_errors[0].get('errmsg'), concern_errors[0].get('code'),
+                                          concern_errors[0])
+                for p in batch:
+                    if p.error is None:
+                        p.error = error
+        except Exception:
+            # Not a per-document failure (network, encoding): retry each on its own
+            # so every caller gets its own outcome
+            for p in batch:
+                p.error = self._insert_alone(p.doc)
+        finally:
+            for p in batch:
+                p.done.set()
+
+    def _insert_alone(self, doc):
+        collection = self._collection()
+        try:
+            collection.insert_one(doc)
+        except DuplicateKeyError as e:
+            # The failed batch may have written this document before it broke off
+            if collection.find_one({'_id': doc['_id']}, {'_id': 1}) is None:
+                return e
+        except Exception as e:
+            return e
+        return None